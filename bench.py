@@ -0,0 +1,374 @@
+"""
+Benchmarks for bertalign.
+
+    python bench.py import-time
+    python bench.py backends --backends torch onnx
+    python bench.py projection --dims 0 256 128
+    python bench.py server --concurrency 16 --requests 200
+    python bench.py second-pass --sents 20000
+    python bench.py dp-threads --sents 20000 --threads 1 2 4 8 16 32
+    python bench.py first-pass --sents 20000
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+HEAVY_MODULES = ['torch', 'faiss', 'numba', 'sentence_transformers', 'transformers']
+
+def bench_import_time(args):
+    """import bertalign.eval 不应该拉起模型和重量级依赖"""
+    code = ('import sys, time\n'
+            't = time.perf_counter()\n'
+            f'import {args.module}\n'
+            'print(time.perf_counter() - t)\n'
+            f'print(",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))\n')
+    times = []
+    for _ in range(args.repeat):
+        out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+        lines = out.stdout.splitlines()
+        times.append(float(lines[0]))
+        loaded = lines[1] if len(lines) > 1 else ''
+    best = min(times)
+    print(f'import {args.module}: best {best * 1000:.1f} ms of {args.repeat}')
+    if loaded:
+        print(f'heavy modules imported: {loaded}')
+    if loaded or best > args.max_seconds:
+        sys.exit(1)
+
+def read_text_berg(data_dir='text+berg'):
+    """读text+berg的德法平行语料和gold对齐"""
+    from bertalign.eval import read_alignments
+    docs = []
+    for name in sorted(os.listdir(os.path.join(data_dir, 'gold'))):
+        with open(os.path.join(data_dir, 'de', name), encoding='utf-8') as f:
+            src_lines = f.read().splitlines()
+        with open(os.path.join(data_dir, 'fr', name), encoding='utf-8') as f:
+            tgt_lines = f.read().splitlines()
+        docs.append((src_lines, tgt_lines, read_alignments(os.path.join(data_dir, 'gold', name))))
+    return docs
+
+def align_pair(src_vecs, tgt_vecs, src_lens, tgt_lens, max_align=5, top_k=3, win=5, skip=-0.1):
+    """和Bertalign.align_sents一样的两步对齐，只对一对语言"""
+    from bertalign.corelib import (find_top_k_sents, get_alignment_types, find_first_search_path,
+                                   first_pass_align, first_back_track, find_second_search_path,
+                                   second_pass_align, second_back_track)
+    src_len, tgt_len = src_vecs.shape[1], tgt_vecs.shape[1]
+    char_ratio = np.sum(src_lens[0,]) / np.sum(tgt_lens[0,])
+    D, I = find_top_k_sents(src_vecs[0, :], tgt_vecs[0, :], k=top_k)
+    first_alignment_types = get_alignment_types(2)
+    first_w, first_path = find_first_search_path(src_len, tgt_len)
+    first_pointers = first_pass_align(src_len, tgt_len, first_w, first_path, first_alignment_types, D, I)
+    first_alignment = first_back_track(src_len, tgt_len, first_pointers, first_path, first_alignment_types)
+    second_alignment_types = get_alignment_types(max_align)
+    second_offsets, second_path = find_second_search_path(first_alignment, win, src_len, tgt_len)
+    second_pointers = second_pass_align(src_vecs, tgt_vecs, src_lens, tgt_lens,
+                                        second_offsets, second_path, second_alignment_types,
+                                        char_ratio, skip, margin=True, len_penalty=True)
+    return second_back_track(src_len, tgt_len, second_pointers, second_offsets, second_path, second_alignment_types)
+
+def bench_backends(args):
+    """比较不同encoder后端在text+berg上的速度和F1"""
+    from bertalign.encoder import Encoder
+    from bertalign.eval import score_multiple, log_final_scores
+    docs = read_text_berg(args.data_dir)
+    for backend in args.backends:
+        encoder = Encoder(args.model, backend=backend)
+        encoder.transform(['warm up'], 1)
+        encode_time = 0
+        gold_list, test_list = [], []
+        for src_lines, tgt_lines, gold in docs:
+            t = time.perf_counter()
+            src_vecs, src_lens = encoder.transform(src_lines, args.max_align - 1)
+            tgt_vecs, tgt_lens = encoder.transform(tgt_lines, args.max_align - 1)
+            encode_time += time.perf_counter() - t
+            test_list.append(align_pair(src_vecs, tgt_vecs, src_lens, tgt_lens, max_align=args.max_align))
+            gold_list.append(gold)
+        res = score_multiple(gold_list=gold_list, test_list=test_list)
+        print(f'backend: {backend}, encode time: {encode_time:.2f} s, '
+              f'f1 strict: {res["f1_strict"]:.4f}, f1 lax: {res["f1_lax"]:.4f}')
+        log_final_scores(res)
+
+def bench_projection(args):
+    """PCA降维后DP的加速比和F1"""
+    from bertalign.encoder import Encoder
+    from bertalign.eval import score_multiple
+    from bertalign.projection import Projection
+    docs = read_text_berg(args.data_dir)
+    encoder = Encoder(args.model, backend=args.backend)
+    encoded = []
+    for src_lines, tgt_lines, gold in docs:
+        encoded.append((encoder.transform(src_lines, args.max_align - 1),
+                        encoder.transform(tgt_lines, args.max_align - 1), gold))
+
+    if args.load:
+        pca = Projection.load(args.load)
+    else:
+        layer0 = [vecs[0] for src, tgt, _ in encoded for vecs, _ in (src, tgt)]
+        pca = Projection.fit_pca(np.concatenate(layer0), max(args.dims))
+        if args.save:
+            pca.save(args.save)
+
+    base_time = None
+    for dim in args.dims:
+        # 0 means the full embedding, smaller dims use the leading PCA components
+        projection = Projection(pca.matrix[:, :dim]) if dim else None
+        docs_vecs = []
+        for (sv, sl), (tv, tl), gold in encoded:
+            if projection is not None:
+                sv, tv = projection.transform(sv), projection.transform(tv)
+            docs_vecs.append((sv, tv, sl, tl, gold))
+        align_pair(*docs_vecs[0][:4], max_align=args.max_align) # numba JIT
+        t = time.perf_counter()
+        test_list = [align_pair(*doc[:4], max_align=args.max_align) for doc in docs_vecs]
+        dp_time = time.perf_counter() - t
+        base_time = base_time or dp_time
+        res = score_multiple(gold_list=[gold for *_, gold in docs_vecs], test_list=test_list)
+        print(f'dim: {dim or "full"}, align time: {dp_time:.3f} s, speedup: {base_time / dp_time:.2f}x, '
+              f'f1 strict: {res["f1_strict"]:.4f}, f1 lax: {res["f1_lax"]:.4f}')
+
+def bench_server(args):
+    """对bertalign.server压测，报告吞吐和延迟分位数
+    服务端要用和数据对应的语言启动：
+        python -m bertalign.server --langs de fr --pivot fr --is-splited
+    """
+    rows = [{"record": f'{i}-{name}', "de": '\n'.join(src_lines), "fr": '\n'.join(tgt_lines)}
+            for i, (name, (src_lines, tgt_lines, _)) in enumerate(
+                zip(sorted(os.listdir(os.path.join(args.data_dir, 'gold'))), read_text_berg(args.data_dir)))]
+    bodies = [json.dumps(rows[i % len(rows)]).encode('utf-8') for i in range(args.requests)]
+    latencies, statuses = [], {}
+
+    async def client(next_body):
+        if args.unix:
+            reader, writer = await asyncio.open_unix_connection(args.unix)
+        else:
+            reader, writer = await asyncio.open_connection(args.host, args.port)
+        for body in next_body:
+            t = time.perf_counter()
+            writer.write(f'POST /align HTTP/1.1\r\nHost: bertalign\r\nContent-Type: application/json\r\n'
+                         f'Content-Length: {len(body)}\r\n\r\n'.encode('latin-1') + body)
+            await writer.drain()
+            line = await reader.readline()
+            if not line: # 服务端关闭了连接
+                statuses['closed'] = statuses.get('closed', 0) + 1
+                break
+            status = int(line.split()[1])
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                name, value = line.decode('latin-1').split(':', 1)
+                if name.lower() == 'content-length':
+                    length = int(value)
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - t)
+            statuses[status] = statuses.get(status, 0) + 1
+        writer.close()
+
+    async def run():
+        next_body = iter(bodies) # 各个连接共用，谁空闲谁发下一个
+        await asyncio.gather(*(client(next_body) for _ in range(args.concurrency)))
+
+    t = time.perf_counter()
+    asyncio.run(run())
+    elapsed = time.perf_counter() - t
+    p50, p99 = np.percentile(latencies, [50, 99])
+    print(f'requests: {len(latencies)}, concurrency: {args.concurrency}, time: {elapsed:.2f} s, '
+          f'throughput: {len(latencies) / elapsed:.2f} req/s, p50: {p50 * 1000:.0f} ms, p99: {p99 * 1000:.0f} ms')
+    print('status:', ', '.join(f'{status}: {count}' for status, count in sorted(statuses.items(), key=str)))
+
+def synthetic_pair(num_sents, dim=768, max_align=5, seed=0):
+    """两篇1-1对齐的合成文档，目标端是源端加噪声，overlap层是窗口内向量的和"""
+    rng = np.random.default_rng(seed)
+    base = rng.normal(size=(num_sents, dim)).astype(np.float32)
+    docs = []
+    for noise in (0, 0.5):
+        vecs = base + noise * rng.normal(size=base.shape).astype(np.float32)
+        cum = np.concatenate([np.zeros((1, dim), dtype=np.float32), np.cumsum(vecs, axis=0)])
+        layers = np.zeros((max_align - 1, num_sents, dim), dtype=np.float32)
+        for layer in range(max_align - 1):
+            layers[layer, layer:] = cum[layer + 1:] - cum[:num_sents - layer]
+        layers /= np.maximum(np.linalg.norm(layers, axis=-1, keepdims=True), 1e-9)
+        lens = np.tile(np.arange(1, max_align)[:, None] * 50, (1, num_sents))
+        docs.append((layers, lens))
+    return docs
+
+def bench_second_pass(args):
+    """第二步DP逐格点积和预先算好相似度band的对比"""
+    from bertalign.corelib import (find_second_search_path, get_alignment_types, second_pass_align,
+                                   compute_band_similarity)
+    (src_vecs, src_lens), (tgt_vecs, tgt_lens) = synthetic_pair(args.sents, args.dim, args.max_align)
+    align_types = get_alignment_types(args.max_align)
+    offsets, path = find_second_search_path([(i, i) for i in range(1, args.sents + 1)], args.win, args.sents, args.sents)
+    kwargs = dict(margin=args.margin, len_penalty=True)
+    small = slice(0, 50)
+    small_offsets, small_path = find_second_search_path([(i, i) for i in range(1, 51)], args.win, 50, 50)
+    # numba JIT
+    second_pass_align(src_vecs[:, small], tgt_vecs[:, small], src_lens[:, small], tgt_lens[:, small],
+                      small_offsets, small_path, align_types, 1.0, -0.1, **kwargs)
+    second_pass_align(src_vecs[:, small], tgt_vecs[:, small], src_lens[:, small], tgt_lens[:, small],
+                      small_offsets, small_path, align_types, 1.0, -0.1,
+                      band=np.zeros((len(align_types), small_offsets[-1]), np.float32), **kwargs)
+
+    t = time.perf_counter()
+    pointers = second_pass_align(src_vecs, tgt_vecs, src_lens, tgt_lens, offsets, path, align_types, 1.0, -0.1, **kwargs)
+    cell_time = time.perf_counter() - t
+    t = time.perf_counter()
+    band = compute_band_similarity(src_vecs, tgt_vecs, offsets, path, align_types, margin=args.margin)
+    band_time = time.perf_counter() - t
+    band_pointers = second_pass_align(src_vecs, tgt_vecs, src_lens, tgt_lens, offsets, path, align_types, 1.0, -0.1,
+                                      band=band, **kwargs)
+    total_time = time.perf_counter() - t
+    print(f'sents: {args.sents}, band cells: {offsets[-1]}, widest row: {np.max(path[:, 1] - path[:, 0]) + 1}, '
+          f'margin: {args.margin}')
+    print(f'per cell: {cell_time:.2f} s, band: {total_time:.2f} s (precompute {band_time:.2f} s), '
+          f'speedup: {cell_time / total_time:.1f}x, same pointers: {np.array_equal(pointers, band_pointers)}')
+
+def bench_dp_threads(args):
+    """顺序DP和按反对角线并行的DP在不同线程数下的对比"""
+    import numba as nb
+    from bertalign.corelib import (find_first_search_path, find_second_search_path, get_alignment_types,
+                                   first_pass_align, first_pass_align_parallel,
+                                   second_pass_align, second_pass_align_parallel)
+    (src_vecs, src_lens), (tgt_vecs, tgt_lens) = synthetic_pair(args.sents, args.dim, args.max_align)
+    rng = np.random.default_rng(0)
+    # faiss的top-k换成对角线附近的随机候选
+    index = np.clip(np.arange(args.sents)[:, None] + rng.integers(-3, 4, size=(args.sents, 3)), 0, args.sents - 1)
+    dist = rng.random(size=index.shape).astype(np.float32)
+    first_types = get_alignment_types(2)
+    first_w, first_path = find_first_search_path(args.sents, args.sents)
+    second_types = get_alignment_types(args.max_align)
+    second_offsets, second_path = find_second_search_path([(i, i) for i in range(1, args.sents + 1)], args.win,
+                                                          args.sents, args.sents)
+    kernels = {
+        'first pass': (first_pass_align, first_pass_align_parallel,
+                       (args.sents, args.sents, first_w, first_path, first_types, dist, index), {}),
+        'second pass': (second_pass_align, second_pass_align_parallel,
+                        (src_vecs, tgt_vecs, src_lens, tgt_lens, second_offsets, second_path, second_types, 1.0, -0.1),
+                        dict(margin=args.margin, len_penalty=True)),
+    }
+    threads = [n for n in args.threads if n <= nb.config.NUMBA_NUM_THREADS]
+    print(f'sents: {args.sents}, numba threads available: {nb.config.NUMBA_NUM_THREADS}, '
+          f'cpu cores: {os.cpu_count()}, tile size: {args.tile_size}')
+    for name, (kernel, parallel_kernel, kernel_args, kwargs) in kernels.items():
+        # numba JIT
+        kernel(*kernel_args, **kwargs)
+        parallel_kernel(*kernel_args, tile_size=args.tile_size, **kwargs)
+        t = time.perf_counter()
+        pointers = kernel(*kernel_args, **kwargs)
+        base_time = time.perf_counter() - t
+        print(f'{name}: sequential {base_time:.2f} s')
+        for n in threads:
+            nb.set_num_threads(n)
+            t = time.perf_counter()
+            parallel_pointers = parallel_kernel(*kernel_args, tile_size=args.tile_size, **kwargs)
+            elapsed = time.perf_counter() - t
+            print(f'  threads: {n:3d}, time: {elapsed:.2f} s, speedup: {base_time / elapsed:.2f}x, '
+                  f'same pointers: {np.array_equal(pointers, parallel_pointers)}')
+    print(f'threading layer: {nb.threading_layer()}')
+
+def bench_first_pass(args):
+    """第一步的banded DP和稀疏的anchor chaining对比"""
+    from bertalign.corelib import (find_first_search_path, find_second_search_path, get_alignment_types,
+                                   first_pass_align, first_back_track, chain_anchors)
+    rng = np.random.default_rng(0)
+    tgt_len = args.sents + args.sents // 20
+    # 对角线附近的top-k候选，top-1大多是对的
+    diagonal = np.arange(args.sents) * tgt_len // args.sents
+    index = np.clip(diagonal[:, None] + rng.integers(-args.spread, args.spread + 1, size=(args.sents, args.top_k)),
+                    0, tgt_len - 1)
+    index[:, 0] = np.where(rng.random(args.sents) < 0.8, diagonal, index[:, 0])
+    dist = np.sort(rng.random(size=index.shape).astype(np.float32), axis=1)[:, ::-1].copy()
+    align_types = get_alignment_types(2)
+
+    def dp():
+        w, path = find_first_search_path(args.sents, tgt_len)
+        pointers = first_pass_align(args.sents, tgt_len, w, path, align_types, dist, index)
+        return first_back_track(args.sents, tgt_len, pointers, path, align_types)
+
+    def chain():
+        return [tuple(anchor) for anchor in chain_anchors(tgt_len, dist, index).tolist()]
+
+    results = {}
+    for name, engine in (('dp', dp), ('chain', chain)):
+        engine() # numba JIT
+        t = time.perf_counter()
+        anchors = engine()
+        elapsed = time.perf_counter() - t
+        offsets, _ = find_second_search_path(list(anchors), args.win, args.sents, tgt_len)
+        results[name] = set(anchors)
+        print(f'{name}: {elapsed:.3f} s, anchors: {len(anchors)}, second-pass band cells: {offsets[-1]}')
+    print(f'common anchors: {len(results["dp"] & results["chain"])}')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('import-time', help='time a cold import in a fresh interpreter')
+    p.add_argument('--module', default='bertalign.eval')
+    p.add_argument('--repeat', type=int, default=5)
+    p.add_argument('--max-seconds', type=float, default=1.0)
+    p.set_defaults(func=bench_import_time)
+
+    p = sub.add_parser('backends', help='encoder speed and alignment F1 per backend on text+berg')
+    p.add_argument('--backends', nargs='+', default=['torch', 'onnx'])
+    p.add_argument('--model', default='LaBSE')
+    p.add_argument('--data-dir', default='text+berg')
+    p.add_argument('--max-align', type=int, default=5)
+    p.set_defaults(func=bench_backends)
+
+    p = sub.add_parser('projection', help='DP speedup against F1 of PCA-projected embeddings on text+berg')
+    p.add_argument('--dims', nargs='+', type=int, default=[0, 256, 128], help='0 for no projection')
+    p.add_argument('--backend', default='torch')
+    p.add_argument('--model', default='LaBSE')
+    p.add_argument('--data-dir', default='text+berg')
+    p.add_argument('--max-align', type=int, default=5)
+    p.add_argument('--save', help='save the fitted PCA to this .npz')
+    p.add_argument('--load', help='reuse a PCA saved with --save')
+    p.set_defaults(func=bench_projection)
+
+    p = sub.add_parser('server', help='throughput and latency of a running bertalign.server on text+berg rows')
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=8765)
+    p.add_argument('--unix', help='connect to this Unix socket instead of host:port')
+    p.add_argument('--data-dir', default='text+berg')
+    p.add_argument('--concurrency', type=int, default=16)
+    p.add_argument('--requests', type=int, default=200)
+    p.set_defaults(func=bench_server)
+
+    p = sub.add_parser('second-pass', help='second-pass DP with per-cell dot products against a precomputed band')
+    p.add_argument('--sents', type=int, default=20000)
+    p.add_argument('--dim', type=int, default=768)
+    p.add_argument('--max-align', type=int, default=5)
+    p.add_argument('--win', type=int, default=5)
+    p.add_argument('--margin', action=argparse.BooleanOptionalAction, default=True)
+    p.set_defaults(func=bench_second_pass)
+
+    p = sub.add_parser('dp-threads', help='scaling of the anti-diagonal parallel DP kernels with the thread count')
+    p.add_argument('--sents', type=int, default=20000)
+    p.add_argument('--dim', type=int, default=768)
+    p.add_argument('--max-align', type=int, default=5)
+    p.add_argument('--win', type=int, default=5)
+    p.add_argument('--margin', action=argparse.BooleanOptionalAction, default=True)
+    p.add_argument('--threads', nargs='+', type=int, default=[1, 2, 4, 8, 16, 32])
+    p.add_argument('--tile-size', type=int, default=32)
+    p.set_defaults(func=bench_dp_threads)
+
+    p = sub.add_parser('first-pass', help='banded first-pass DP against sparse anchor chaining')
+    p.add_argument('--sents', type=int, default=20000)
+    p.add_argument('--top-k', type=int, default=3)
+    p.add_argument('--spread', type=int, default=50, help='distance of the wrong candidates from the diagonal')
+    p.add_argument('--win', type=int, default=5)
+    p.set_defaults(func=bench_first_pass)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
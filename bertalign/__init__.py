@@ -5,12 +5,30 @@ Bertalign initialization
 __author__ = "Jason (bfsujason@163.com)"
 __version__ = "1.1.0"
 
+import os
+
 from bertalign.encoder import Encoder
 
 # See other cross-lingual embedding models at
 # https://www.sbert.net/docs/pretrained_models.html
 
-model_name = "LaBSE"
-model = Encoder(model_name)
+# The model is only loaded when the first sentences are encoded,
+# so importing bertalign.eval or bertalign.utils stays cheap.
+model_name = os.environ.get("BERTALIGN_MODEL", "LaBSE")
+device = os.environ.get("BERTALIGN_DEVICE")
+backend = os.environ.get("BERTALIGN_BACKEND", "torch") # "onnx" for int8 ONNX Runtime on CPU
+model = Encoder(model_name, device=device, backend=backend)
+
+# Embeddings can be cached on disk across records and runs:
+#   from bertalign.cache import EmbeddingStore
+#   model.store = EmbeddingStore("embedding_cache", model_name)
+#   model.store.stats()  # hit/miss counters
+# and spread over several CPU worker processes sharing one copy of the model:
+#   model.start_pool(num_workers=8)
 
-from bertalign.aligner import Bertalign
+def __getattr__(name):
+    # Bertalign pulls in numba and the DP kernels, import it on first access.
+    if name == "Bertalign":
+        from bertalign.aligner import Bertalign
+        return Bertalign
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,30 +1,131 @@
 import numpy as np
+import numba as nb
 
-from bertalign import model
+import itertools
+import threading
+import bertalign
+
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 from bertalign.corelib import *
 from bertalign.utils import *
+from bertalign.projection import Projection
+from bertalign.result import BeadArray
 lang_list = ["en", "zh", "fr", 'ru', "es"]
 # lang_list = ["en", "zh"]
 
+# 对齐过的语言对数和走了近对角线捷径的次数
+align_stats = Counter()
+_stats_lock = threading.Lock()
+FAST_PATH_WIN = 2
+# 第二步的相似度band超过这个大小就退回逐格计算
+MAX_BAND_BYTES = 1 << 30
+# 分块时在块的[1/4, 3/4]里找切点，块太小就切不动了
+MIN_CHUNK_SIZE = 8
+# margin="knn"时每个向量取另一边最相似的几个单句
+KNN_MARGIN_K = 4
+
 class Bertalign:
-    def __init__(self, row, max_align=5, top_k=3, win=5, skip=-0.1, margin=True, len_penalty=True, is_splited=False, split_to_sents=False, log_func=print):
+    def __init__(self, row, max_align=5, top_k=3, win=5, skip=-0.1, margin=True, len_penalty=True, is_splited=False, split_to_sents=False, log_func=print, pipeline=False, vec_dtype="float32", projection=None, workers=1, encode=True, langs=None, pivot="en", chunk_size=None, previous=None, paragraphs=False, fast_path=True, dp_threads=1, first_pass="dp"):
+        """
+        Args:
+            margin: bool or "knn". True subtracts the similarity to the neighbouring
+                    sentences, "knn" the mean similarity of each side to its
+                    KNN_MARGIN_K nearest sentences on the other side.
+            pipeline: bool. Only encode the single-sentence layer up front and
+                      encode the overlap layers in a background thread, so the
+                      first-pass alignment can start while they are encoding.
+            vec_dtype: str. Storage of the overlap embeddings, "float32",
+                       "float16" or "int8" (one scale per vector).
+            projection: Projection or path of a saved one. Reduces the embeddings
+                        to fewer dimensions before the alignment.
+            workers: int. Number of language pairs aligned concurrently.
+            encode: bool. Encode the sentences right away, False when the
+                    caller sets the embeddings itself like align_many.
+            langs: list of str. Languages of row to align, lang_list by default.
+                   Only these are split and encoded.
+            pivot: str. Every other language is aligned to this one.
+            chunk_size: int. Align documents longer than chunk_size source
+                        sentences segment by segment, cut at confident anchors
+                        of the whole document, so the DP memory is bounded by
+                        the distance between cuts, chunk_size when the document
+                        has enough confident anchors.
+                        At least MIN_CHUNK_SIZE. The second pass of a segment
+                        does not see the sentences beyond its cuts, so the
+                        margin of the beads next to a cut only uses the
+                        neighbour inside the segment and may differ from the
+                        unchunked alignment.
+            previous: Bertalign. Earlier alignment of the same record with the
+                      same model and settings. Sentences are diffed against it,
+                      only the changed overlap windows are encoded and only the
+                      regions around changed beads are aligned again. Like a
+                      chunk, a region does not see the sentences around it,
+                      so with margin=True its first and last beads may differ
+                      from a full alignment.
+            paragraphs: bool. Align the paragraphs first, the lines of row[lang]
+                        with split_to_sents, then align the sentences only
+                        within each group of aligned paragraphs. Needs
+                        split_to_sents, ValueError otherwise.
+            fast_path: bool. When both languages have the same number of
+                       sentences and the layer-0 embeddings pass is_near_diagonal,
+                       with no run of more than FAST_PATH_WIN sentences off the
+                       diagonal, skip faiss and the first pass and run the second
+                       pass in a band of FAST_PATH_WIN around the diagonal.
+                       align_stats counts it.
+            dp_threads: int. Numba threads of the DP kernels. With more than one
+                        the tiled wavefront kernels are used, they give the
+                        same alignment. Off by default: the second-pass band is
+                        only a few tiles wide, so the speed-up is small, see
+                        bench.py dp-threads. Combined with workers > 1 this
+                        needs the tbb or omp numba threading layer.
+            first_pass: str. "dp" for the banded first-pass DP, "chain" to chain
+                        the top-k faiss candidates into the best increasing
+                        sequence of anchors with chain_anchors, which has no
+                        window and runs in O(n * top_k * log n).
+        """
         self.max_align = max_align
+        self.vec_dtype = vec_dtype
+        self.workers = workers
+        if chunk_size is not None and chunk_size < MIN_CHUNK_SIZE:
+            raise ValueError("chunk_size must be at least {}".format(MIN_CHUNK_SIZE))
+        self.chunk_size = chunk_size
+        if paragraphs and not split_to_sents:
+            raise ValueError("paragraphs=True needs split_to_sents=True, the paragraphs are the lines of row[lang]")
+        self.paragraphs = paragraphs
+        self.fast_path = fast_path
+        self.dp_threads = dp_threads
+        if first_pass not in ("dp", "chain"):
+            raise Exception('Unknown first pass {}'.format(first_pass))
+        self.first_pass = first_pass
+        self._wait_lock = threading.Lock()
+        if isinstance(projection, str):
+            projection = Projection.load(projection)
+        self.projection = projection
         self.top_k = top_k
         self.win = win
         self.skip = skip
+        if margin not in (True, False, "knn"):
+            raise Exception('Unknown margin {}'.format(margin))
         self.margin = margin
+        self._knn_margins = {}
         self.len_penalty = len_penalty
         self.log_func = log_func # 日志函数，会传入一个字符串
         self.record = row['record']
+        self.pivot = pivot
+        self.langs = [pivot] + [lang for lang in (langs or lang_list) if lang != pivot]
 
         sents = {}
 
-        for lang in lang_list:
+        for lang in self.langs:
             sents[lang] = {}
             if split_to_sents:
                 text_lines = []
+                para_bounds = [0]
                 for s in row[lang].splitlines():
                     text_lines.extend(auto_split_sents(s, lang))
+                    if len(text_lines) > para_bounds[-1]: # 跳过没有句子的段落
+                        para_bounds.append(len(text_lines))
+                sents[lang]["para_bounds"] = np.array(para_bounds)
             else:
                 if is_splited:
                     text_lines = row[lang].splitlines()
@@ -36,76 +137,479 @@ class Bertalign:
             # special_lang = LANG.ISO[lang]
             log_func(f"record: {self.record}, lang: {lang}, sent len: {lines_length}")
 
-            vecs, lens = model.transform(text_lines, max_align - 1)
             sents[lang]["lines_length"] = lines_length
             # sents[lang]["special_lang"] = special_lang
-            sents[lang]["vecs"] = vecs
-            sents[lang]["lens"] = lens
             sents[lang]["text_lines"] = text_lines
 
-            if "en" in sents:
-                sents[lang]["char_ratio"] = np.sum(lens[0,]) / np.sum(sents["en"]["lens"][0,])
+        self.sents = sents
+        self._previous = previous if self._can_reuse(previous) else None
+        if self._previous is not None:
+            for lang in self.langs:
+                if lang in self._previous.sents:
+                    sents[lang]["old_index"] = diff_lines(self._previous.sents[lang]["text_lines"],
+                                                          sents[lang]["text_lines"])
+        if encode:
+            if self._previous is not None:
+                self._encode_incremental()
+            else:
+                self._encode(pipeline)
 
+    @classmethod
+    def align_many(cls, rows, batch_records=16, dp_workers=4, **kwargs):
+        """
+        Align many records. The sentences of batch_records records are encoded
+        in one Encoder call, and the DP of each record runs on a thread pool
+        while the next batch is being encoded.
+        Args:
+            rows: iterable of rows, same as the row of Bertalign.
+            batch_records: int. Number of records encoded together.
+            dp_workers: int. Number of records aligned concurrently.
+            kwargs: passed to Bertalign, except pipeline.
+        Yields:
+            aligned Bertalign objects in the order of rows, as soon as they are done.
+            Encoding waits while 2 * dp_workers + batch_records records are
+            encoded but not yielded yet, so their embeddings stay bounded.
+        """
+        max_pending = 2 * dp_workers + batch_records
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=dp_workers) as executor:
+            for batch in _batched(rows, batch_records):
+                for aligner in cls.encode_many(batch, **kwargs):
+                    pending.append((aligner, executor.submit(aligner.align_sents)))
 
-        self.sents = sents
-   
-        
+                while pending and (pending[0][1].done() or len(pending) > max_pending):
+                    aligner, future = pending.popleft()
+                    future.result()
+                    yield aligner
+            while pending:
+                aligner, future = pending.popleft()
+                future.result()
+                yield aligner
+
+    @classmethod
+    def encode_many(cls, rows, **kwargs):
+        """
+        Split and encode the rows with a single Encoder call.
+        Returns:
+            list of Bertalign objects ready for align_sents.
+        """
+        if "pipeline" in kwargs:
+            raise TypeError("pipeline is not supported when encoding several records together")
+        return cls.encode_together([cls(row, encode=False, **kwargs) for row in rows])
+
+    @staticmethod
+    def encode_together(aligners):
+        """
+        Encode Bertalign objects created with encode=False in a single Encoder call.
+        Returns:
+            aligners, ready for align_sents.
+        """
+        if not aligners:
+            return aligners
+        docs = [aligner.sents[lang]["text_lines"] for aligner in aligners for lang in aligner.sents]
+        encoded = iter(bertalign.model.transform_many(docs, aligners[0].max_align - 1))
+        for aligner in aligners:
+            for lang in aligner.sents:
+                aligner._set_embeddings(lang, *next(encoded))
+        return aligners
+
+    def _encode(self, pipeline=False):
+        executor = ThreadPoolExecutor(max_workers=1) if pipeline and self.max_align > 2 else None
+        for lang in self.sents:
+            text_lines = self.sents[lang]["text_lines"]
+            if executor is not None:
+                vecs, lens = bertalign.model.transform(text_lines, 1)
+                self.sents[lang]["pending"] = executor.submit(bertalign.model.transform, text_lines, self.max_align - 1, 2)
+            else:
+                vecs, lens = bertalign.model.transform(text_lines, self.max_align - 1)
+            self._set_embeddings(lang, vecs, lens)
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def _can_reuse(self, previous):
+        if previous is None or not hasattr(previous, "result"):
+            return False
+        if previous.projection is None or self.projection is None:
+            same_projection = previous.projection is self.projection
+        else:
+            same_projection = np.array_equal(previous.projection.matrix, self.projection.matrix)
+        return same_projection and previous.pivot == self.pivot and all(
+            getattr(previous, name) == getattr(self, name)
+            for name in ("max_align", "vec_dtype", "top_k", "win", "skip", "margin", "len_penalty", "first_pass"))
+
+    def _encode_incremental(self):
+        """
+        Take the overlap embeddings of unchanged windows from the previous
+        aligner and only encode the windows that contain a changed sentence.
+        """
+        num_layers = self.max_align - 1
+        for lang in self.sents:
+            data = self.sents[lang]
+            text_lines = data["text_lines"]
+            if "old_index" not in data:
+                self._set_embeddings(lang, *bertalign.model.transform(text_lines, num_layers))
+                continue
+            self._previous._wait_overlaps(lang)
+            old = self._previous.sents[lang]
+            old_index = data["old_index"]
+            num_lines = len(text_lines)
+
+            # 窗口里的句子都没改且在旧文本里连续，就能用旧向量
+            changed = np.concatenate([[0], np.cumsum(old_index < 0)])
+            old_pos = np.full((num_layers, num_lines), -1)
+            missing = []
+            for layer in range(num_layers):
+                ends = np.arange(layer, num_lines)
+                same = (changed[ends + 1] == changed[ends - layer]) & (old_index[ends] - old_index[ends - layer] == layer)
+                old_pos[layer, ends[same]] = old_index[ends[same]]
+                missing.extend((layer, end) for end in ends[~same])
+
+            vecs = np.zeros((num_layers, num_lines) + old["vecs"].shape[2:], dtype=old["vecs"].dtype)
+            scales = None if old["scales"] is None else np.ones((num_layers, num_lines), dtype=np.float32)
+            layers, ends = np.nonzero(old_pos >= 0)
+            vecs[layers, ends] = old["vecs"][layers, old_pos[layers, ends]]
+            if scales is not None:
+                scales[layers, ends] = old["scales"][layers, old_pos[layers, ends]]
+            if missing:
+                new_vecs = bertalign.model.encode([overlap_line(text_lines, end, layer + 1) for layer, end in missing])
+                if self.projection is not None:
+                    new_vecs = self.projection.transform(new_vecs)
+                new_vecs, new_scales = compress_vecs(new_vecs, self.vec_dtype)
+                layers, ends = np.array(missing).T
+                vecs[layers, ends] = new_vecs
+                if scales is not None:
+                    scales[layers, ends] = new_scales
+            data["vecs"], data["scales"] = vecs, scales
+            data["lens"] = overlap_lengths(text_lines, num_layers)
+
+    def _set_embeddings(self, lang, vecs, lens):
+        data = self.sents[lang]
+        if self.projection is not None:
+            vecs = self.projection.transform(vecs)
+        data["vecs"], data["scales"] = compress_vecs(vecs, self.vec_dtype)
+        data["lens"] = lens
 
     def align_sents(self):
+        """
+        Align every language to the pivot. The language pairs only share
+        read-only pivot data and the DP kernels release the GIL, so with
+        workers > 1 they run concurrently on a thread pool.
+        """
+        langs = self.langs[1:]
+        self._knn_margins = {}
+        if self.workers > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                alignments = list(executor.map(self._align_lang, langs))
+        else:
+            alignments = [self._align_lang(lang) for lang in langs]
+        self.result = dict(zip(langs, alignments))
+        self._previous = None
 
-        result = {}
-        benchmark_data = self.sents["en"]
+    def _realign_lang(self, lang, char_ratio):
+        """
+        Keep the beads of the previous alignment whose sentences are unchanged
+        and still consecutive, and align the gaps between them again. Gaps are
+        widened by one bead on each side, so the beads next to an edit can change.
+        """
+        src_inv = _invert_index(self.sents[lang]["old_index"], self._previous.sents[lang]["lines_length"])
+        tgt_inv = _invert_index(self.sents[self.pivot]["old_index"], self._previous.sents[self.pivot]["lines_length"])
+        kept = []
+        for src_bead, tgt_bead in self._previous.result[lang]:
+            src_bead = [int(src_inv[i]) for i in src_bead]
+            tgt_bead = [int(tgt_inv[j]) for j in tgt_bead]
+            if _is_run(src_bead) and _is_run(tgt_bead):
+                kept.append((src_bead, tgt_bead))
 
-        for lang in lang_list[1:]:
-            src = self.sents[lang]
-            # print("Performing first-step alignment ...") # 第一次对齐：原句对齐，所以只需要[0,:]
-            D, I = find_top_k_sents(src["vecs"][0,:], benchmark_data["vecs"][0,:], k=self.top_k)
-            first_alignment_types = get_alignment_types(2) 
-            first_w, first_path = find_first_search_path(src["lines_length"], benchmark_data["lines_length"])
-            first_pointers = first_pass_align(src["lines_length"], benchmark_data["lines_length"], first_w, first_path, first_alignment_types, D, I)
-            first_alignment = first_back_track(src["lines_length"], benchmark_data["lines_length"], first_pointers, first_path, first_alignment_types)
+        src_len = self.sents[lang]["lines_length"]
+        tgt_len = self.sents[self.pivot]["lines_length"]
+        drop = set()
+        for k, *_ in _bead_gaps(kept, src_len, tgt_len):
+            drop.update((k - 1, k))
+        kept = [bead for k, bead in enumerate(kept) if k not in drop]
+        gaps = {k: gap for k, *gap in _bead_gaps(kept, src_len, tgt_len)}
 
-            # print("Performing second-step alignment ...")
-            second_alignment_types = get_alignment_types(self.max_align)
-            second_w, second_path = find_second_search_path(first_alignment, self.win, src["lines_length"], benchmark_data["lines_length"])
-            second_pointers = second_pass_align(src["vecs"], benchmark_data["vecs"], src["lens"], benchmark_data["lens"],
-                                            second_w, second_path, second_alignment_types,
-                                            src["char_ratio"], self.skip, margin=self.margin, len_penalty=self.len_penalty)
-            second_alignment = second_back_track(src["lines_length"], benchmark_data["lines_length"], second_pointers, second_path, second_alignment_types)
+        alignment = []
+        for k, bead in enumerate(kept + [None]):
+            if k in gaps:
+                alignment.extend(self._align_segment(lang, char_ratio, *gaps[k]))
+            if bead is not None:
+                alignment.append(bead)
+        return alignment
 
-            result[lang] = second_alignment
+    def _align_segment(self, lang, char_ratio, src_start, tgt_start, src_end, tgt_end):
+        """两步对齐[src_start, src_end) x [tgt_start, tgt_end)"""
+        anchors = []
+        if src_end > src_start and tgt_end > tgt_start:
+            D, I = find_top_k_sents(self._layer0(lang, src_start, src_end), self._layer0(self.pivot, tgt_start, tgt_end),
+                                    k=min(self.top_k, tgt_end - tgt_start))
+            anchors = self._first_pass(src_end - src_start, tgt_end - tgt_start, D, I)
+        return self._second_pass(lang, char_ratio, src_start, tgt_start, src_end, tgt_end, anchors)
+
+    def _align_lang(self, lang):
+        src = self.sents[lang]
+        benchmark_data = self.sents[self.pivot]
+        src_len = src["lines_length"]
+        tgt_len = benchmark_data["lines_length"]
+        char_ratio = np.sum(src["lens"][0,]) / np.sum(benchmark_data["lens"][0,])
+        _count("pairs")
+        if self._previous is not None and lang in self._previous.result and "old_index" in src and "old_index" in benchmark_data:
+            return self._score_beads(lang, char_ratio, self._realign_lang(lang, char_ratio))
+        if self.paragraphs:
+            groups = self._align_paragraphs(lang, char_ratio)
+            self._wait_overlaps(self.pivot)
+            self._wait_overlaps(lang)
+            if self.workers > 1:
+                with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                    aligned = list(executor.map(lambda group: self._align_segment(lang, char_ratio, *group), groups))
+            else:
+                aligned = [self._align_segment(lang, char_ratio, *group) for group in groups]
+            return self._score_beads(lang, char_ratio, [bead for beads in aligned for bead in beads])
+        src_vecs = self._layer0(lang)
+        tgt_vecs = self._layer0(self.pivot)
+        if self.fast_path and src_len == tgt_len and is_near_diagonal(src_vecs, tgt_vecs, max_run=FAST_PATH_WIN):
+            _count("fast_path")
+            self._wait_overlaps(self.pivot)
+            self._wait_overlaps(lang)
+            diagonal = [(i, i) for i in range(1, src_len + 1)]
+            return self._score_beads(lang, char_ratio, self._second_pass(lang, char_ratio, 0, 0, src_len, tgt_len,
+                                                                         diagonal, win=FAST_PATH_WIN))
+        # print("Performing first-step alignment ...") # 第一次对齐：原句对齐，所以只需要[0,:]
+        D, I = find_top_k_sents(src_vecs, tgt_vecs, k=self.top_k)
+        if self.chunk_size and src_len > self.chunk_size:
+            segments = self._chunked_first_pass(src_len, tgt_len, D, I)
+        else:
+            segments = [(0, 0, src_len, tgt_len, self._first_pass(src_len, tgt_len, D, I))]
 
-        self.result = result
+        # print("Performing second-step alignment ...")
+        self._wait_overlaps(self.pivot)
+        self._wait_overlaps(lang)
+        if len(segments) > 1 and self.workers > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                aligned = list(executor.map(lambda seg: self._second_pass(lang, char_ratio, *seg), segments))
+        else:
+            aligned = [self._second_pass(lang, char_ratio, *seg) for seg in segments]
+        return self._score_beads(lang, char_ratio, [bead for beads in aligned for bead in beads])
 
+    def _score_beads(self, lang, char_ratio, alignment):
+        """把对齐结果转成BeadArray，附上每个bead的分数"""
+        beads = BeadArray.from_beads(alignment)
+        src = self.sents[lang]
+        tgt = self.sents[self.pivot]
+        types = beads.types
+        src_margins, tgt_margins = self._margin_tables(lang)
+        beads.score, beads.similarity, beads.margin = score_beads(src["vecs"], tgt["vecs"], src["lens"], tgt["lens"],
+                                                                  beads.src_end, beads.tgt_end, types[:, 0], types[:, 1],
+                                                                  char_ratio, self.skip, margin=self.margin is True, len_penalty=self.len_penalty,
+                                                                  src_scales=src["scales"], tgt_scales=tgt["scales"],
+                                                                  src_margins=src_margins, tgt_margins=tgt_margins)
+        return beads
+
+    def _align_paragraphs(self, lang, char_ratio):
+        """
+        Two-pass alignment of the paragraphs, embedded as the normalized sum
+        of their sentence embeddings.
+        Returns:
+            list of (src_start, tgt_start, src_end, tgt_end) sentence ranges of
+            the aligned paragraph groups.
+        """
+        src_bounds = self.sents[lang]["para_bounds"]
+        tgt_bounds = self.sents[self.pivot]["para_bounds"]
+        src_len = len(src_bounds) - 1
+        tgt_len = len(tgt_bounds) - 1
+        if src_len == 0 or tgt_len == 0:
+            return [(0, 0, int(src_bounds[-1]), int(tgt_bounds[-1]))]
+        src_vecs, src_lens = paragraph_embeddings(self._layer0(lang), self.sents[lang]["lens"][0], src_bounds, self.max_align - 1)
+        tgt_vecs, tgt_lens = paragraph_embeddings(self._layer0(self.pivot), self.sents[self.pivot]["lens"][0], tgt_bounds, self.max_align - 1)
+        D, I = find_top_k_sents(src_vecs[0], tgt_vecs[0], k=min(self.top_k, tgt_len))
+        first_alignment = self._first_pass(src_len, tgt_len, D, I)
+        second_alignment_types = get_alignment_types(self.max_align)
+        second_offsets, second_path = find_second_search_path(first_alignment or [(src_len, tgt_len)], self.win, src_len, tgt_len)
+        src_margins, tgt_margins = None, None
+        if self.margin == "knn":
+            src_margins, tgt_margins = knn_margins(src_vecs, tgt_vecs, k=KNN_MARGIN_K)
+        second_pointers = self._run_dp(second_pass_align, second_pass_align_parallel,
+                                       src_vecs, tgt_vecs, src_lens, tgt_lens,
+                                       second_offsets, second_path, second_alignment_types,
+                                       char_ratio, self.skip, margin=self.margin is True, len_penalty=self.len_penalty,
+                                       src_margins=src_margins, tgt_margins=tgt_margins)
+        groups = BeadArray.from_beads(second_back_track(src_len, tgt_len, second_pointers, second_offsets,
+                                                        second_path, second_alignment_types))
+        return list(zip(src_bounds[groups.src_start].tolist(), tgt_bounds[groups.tgt_start].tolist(),
+                        src_bounds[groups.src_end].tolist(), tgt_bounds[groups.tgt_end].tolist()))
+
+    def _first_pass(self, src_len, tgt_len, D, I):
+        if self.first_pass == "chain":
+            return [tuple(anchor) for anchor in chain_anchors(tgt_len, D, I).tolist()]
+        first_alignment_types = get_alignment_types(2) 
+        first_w, first_path = find_first_search_path(src_len, tgt_len)
+        first_pointers = self._run_dp(first_pass_align, first_pass_align_parallel,
+                                      src_len, tgt_len, first_w, first_path, first_alignment_types, D, I)
+        return first_back_track(src_len, tgt_len, first_pointers, first_path, first_alignment_types)
+
+    def _chunked_first_pass(self, src_len, tgt_len, D, I):
+        """
+        Cut the document at confident anchors of chain_anchors over the whole
+        top-k table, about every chunk_size source sentences, and run the first
+        pass on each segment. The cuts do not depend on where the target
+        sentences are expected to be, so offsets between the documents are
+        followed. Where no confident anchor is found the window grows until
+        one is, so a segment can be longer than chunk_size.
+        Returns:
+            list of (src_start, tgt_start, src_end, tgt_end, anchors), anchors
+            being the first-pass 1-1 alignments relative to the segment start.
+        """
+        chain = [tuple(anchor) for anchor in chain_anchors(tgt_len, D, I).tolist()]
+        cuts = []
+        s0 = 0
+        while src_len - s0 > self.chunk_size:
+            hi = s0 + self.chunk_size * 3 // 4
+            cut = None
+            while cut is None and hi < src_len:
+                cut = find_cut_anchor(chain, I, s0 + self.chunk_size // 4, hi)
+                hi += self.chunk_size // 2 # 没有可信的锚点就扩大窗口
+            if cut is None:
+                break
+            assert cut[0] > s0, "chunked first pass did not advance"
+            cuts.append(cut)
+            s0 = cut[0]
+
+        segments = []
+        for (s0, t0), (s1, t1) in zip([(0, 0)] + cuts, cuts + [(src_len, tgt_len)]):
+            anchors = []
+            if t1 > t0:
+                anchors = self._first_pass(s1 - s0, t1 - t0, D[s0:s1], I[s0:s1] - t0)
+            segments.append((s0, t0, s1, t1, anchors))
+        return segments
+
+    def _second_pass(self, lang, char_ratio, src_start, tgt_start, src_end, tgt_end, anchors, win=None):
+        """在[src_start, src_end) x [tgt_start, tgt_end)内做第二遍对齐，返回全局下标的beads"""
+        if src_end == src_start or tgt_end == tgt_start:
+            return [([i], []) for i in range(src_start, src_end)] + [([], [j]) for j in range(tgt_start, tgt_end)]
+        src_len = src_end - src_start
+        tgt_len = tgt_end - tgt_start
+        src = _slice_sents(self.sents[lang], src_start, src_end)
+        tgt = _slice_sents(self.sents[self.pivot], tgt_start, tgt_end)
+        second_alignment_types = get_alignment_types(self.max_align)
+        second_offsets, second_path = find_second_search_path(list(anchors) or [(src_len, tgt_len)], self.win if win is None else win, src_len, tgt_len)
+        src_margins, tgt_margins = self._margin_tables(lang)
+        if src_margins is not None:
+            src_margins = src_margins[:, src_start:src_end]
+            tgt_margins = tgt_margins[:, tgt_start:tgt_end]
+        margin = self.margin is True
+        band = None
+        if len(second_alignment_types) * second_offsets[-1] * 4 <= MAX_BAND_BYTES:
+            band = compute_band_similarity(src["vecs"], tgt["vecs"], second_offsets, second_path, second_alignment_types,
+                                           margin=margin, src_scales=src["scales"], tgt_scales=tgt["scales"])
+        second_pointers = self._run_dp(second_pass_align, second_pass_align_parallel,
+                                       src["vecs"], tgt["vecs"], src["lens"], tgt["lens"],
+                                       second_offsets, second_path, second_alignment_types,
+                                       char_ratio, self.skip, margin=margin, len_penalty=self.len_penalty,
+                                       src_scales=src["scales"], tgt_scales=tgt["scales"], band=band,
+                                       src_margins=src_margins, tgt_margins=tgt_margins)
+        alignment = second_back_track(src_len, tgt_len, second_pointers, second_offsets, second_path, second_alignment_types)
+        if src_start == 0 and tgt_start == 0:
+            return alignment
+        return [([i + src_start for i in src_bead], [j + tgt_start for j in tgt_bead]) for src_bead, tgt_bead in alignment]
+
+    def _run_dp(self, kernel, parallel_kernel, *args, **kwargs):
+        """dp_threads > 1时用按反对角线并行的kernel，线程数是调用线程自己的设置"""
+        if self.dp_threads > 1:
+            nb.set_num_threads(min(self.dp_threads, nb.config.NUMBA_NUM_THREADS))
+            return parallel_kernel(*args, **kwargs)
+        return kernel(*args, **kwargs)
+
+    def _margin_tables(self, lang):
+        """margin="knn"时lang和pivot整篇的k-NN margin，每个语言对算一次"""
+        if self.margin != "knn":
+            return None, None
+        if lang not in self._knn_margins:
+            src = self.sents[lang]
+            tgt = self.sents[self.pivot]
+            self._knn_margins[lang] = knn_margins(src["vecs"], tgt["vecs"], k=KNN_MARGIN_K,
+                                                  src_scales=src["scales"], tgt_scales=tgt["scales"])
+        return self._knn_margins[lang]
+
+    def _wait_overlaps(self, lang):
+        """等后台线程把lang的overlap层编码完，拼到layer 0后面"""
+        data = self.sents[lang]
+        with self._wait_lock:
+            pending = data.pop("pending", None)
+            if pending is None:
+                return
+            vecs, lens = pending.result()
+            if self.projection is not None:
+                vecs = self.projection.transform(vecs)
+            vecs, scales = compress_vecs(vecs, self.vec_dtype)
+            data["vecs"] = np.concatenate([data["vecs"], vecs])
+            data["lens"] = np.concatenate([data["lens"], lens])
+            if scales is not None:
+                data["scales"] = np.concatenate([data["scales"], scales])
+
+    def _layer0(self, lang, start=0, end=None):
+        """faiss要float32的单句向量"""
+        data = self.sents[lang]
+        scales = data["scales"]
+        return decompress_vecs(data["vecs"][0, start:end], None if scales is None else scales[0, start:end])
 
     def create_result(self):
         result = {}
         for lang in self.result:
-            result[lang] = ""
-            for bead in (self.result[lang]):
-                src_line = self._get_line(bead[0], self.sents[lang]["text_lines"])
-                tgt_line = self._get_line(bead[1], self.sents["en"]["text_lines"])
-                result[lang]+= src_line + "\n" + tgt_line + "\n \n"
-
+            texts = self.result[lang].texts(self.sents[lang]["text_lines"], self.sents[self.pivot]["text_lines"])
+            result[lang] = "".join(src_line + "\n" + tgt_line + "\n \n" for src_line, tgt_line in texts)
         return result
 
     def print_sents(self):
         for lang in self.result:
-            for bead in (self.result[lang]):
-                src_line = self._get_line(bead[0], self.sents[lang]["text_lines"])
-                tgt_line = self._get_line(bead[1], self.sents["en"]["text_lines"])
+            for src_line, tgt_line in self.result[lang].texts(self.sents[lang]["text_lines"], self.sents[self.pivot]["text_lines"]):
                 print(src_line + "\n" + tgt_line + "\n")
 
-            
     def yield_sents(self):
-        for bead in (self.result):
-            src_line = self._get_line(bead[0], self.src_sents)
-            tgt_line = self._get_line(bead[1], self.tgt_sents)
-            yield src_line + "\n++++++++++\n" + tgt_line + "\n"
+        for lang in self.result:
+            for src_line, tgt_line in self.result[lang].texts(self.sents[lang]["text_lines"], self.sents[self.pivot]["text_lines"]):
+                yield src_line + "\n++++++++++\n" + tgt_line + "\n"
 
-    @staticmethod
-    def _get_line(bead, lines):
-        line = ''
-        if len(bead) > 0:
-            line = ' '.join(lines[bead[0]:bead[-1]+1])
-        return line
+def _batched(iterable, n):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, n))
+        if not batch:
+            return
+        yield batch
+
+def _count(key):
+    with _stats_lock:
+        align_stats[key] += 1
+
+def _slice_sents(data, start, end):
+    if start == 0 and end == data["lines_length"]:
+        return data
+    scales = data["scales"]
+    return {"vecs": data["vecs"][:, start:end],
+            "lens": data["lens"][:, start:end],
+            "scales": None if scales is None else scales[:, start:end]}
+
+def _invert_index(index, old_len):
+    """diff_lines的反向：旧下标到新下标，删掉或改过的是-1"""
+    inverse = np.full(old_len, -1, dtype=np.int64)
+    mapped = index >= 0
+    inverse[index[mapped]] = np.nonzero(mapped)[0]
+    return inverse
+
+def _is_run(bead):
+    return all(i >= 0 for i in bead) and (len(bead) == 0 or bead[-1] - bead[0] == len(bead) - 1)
+
+def _bead_gaps(beads, src_len, tgt_len):
+    """
+    Sentences not covered by beads, as (k, src_start, tgt_start, src_end, tgt_end)
+    for the gap before beads[k], k being len(beads) for the gap at the end.
+    """
+    src_pos, tgt_pos = 0, 0
+    for k, (src_bead, tgt_bead) in enumerate(beads + [([src_len], [tgt_len])]):
+        src_start = src_bead[0] if src_bead else src_pos
+        tgt_start = tgt_bead[0] if tgt_bead else tgt_pos
+        if (src_start, tgt_start) != (src_pos, tgt_pos):
+            yield k, src_pos, tgt_pos, src_start, tgt_start
+        if src_bead:
+            src_pos = src_bead[-1] + 1
+        if tgt_bead:
+            tgt_pos = tgt_bead[-1] + 1
@@ -0,0 +1,100 @@
+import re
+import json
+import numpy as np
+
+from pathlib import Path
+
+class OnnxBackend:
+    """
+    ONNX Runtime encoder backend for CPU inference.
+    The whole sentence-transformers pipeline (transformer, pooling, dense,
+    normalize) is exported once, optionally quantized to int8 with dynamic
+    quantization, and cached under cache_dir together with the tokenizer.
+    Implements the part of SentenceTransformer that Encoder uses:
+    encode(), tokenizer and get_max_seq_length().
+    """
+    def __init__(self, model_name, cache_dir="onnx_models", quantize=True, num_threads=None):
+        """
+        Args:
+            model_name: str. Name of the sentence-transformers model.
+            cache_dir: str. Directory of the exported models.
+            quantize: bool. Use the int8 model instead of the fp32 one.
+            num_threads: int. Intra-op threads of onnxruntime, all cores if None.
+        """
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        model_dir = Path(cache_dir) / re.sub(r'[^\w.-]', '_', model_name)
+        model_path = model_dir / ("model.int8.onnx" if quantize else "model.onnx")
+        if not model_path.exists():
+            export_onnx(model_name, model_dir, quantize=quantize)
+
+        self.model_path = model_path
+        self.set_num_threads(num_threads)
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.tokenizer = AutoTokenizer.from_pretrained(str(model_dir))
+        with open(model_dir / "bertalign.json", encoding="utf-8") as f:
+            self.max_seq_length = json.load(f)["max_seq_length"]
+
+    def encode(self, sentences, batch_size=32, **kwargs):
+        vecs = []
+        for start in range(0, len(sentences), batch_size):
+            encoded = self.tokenizer(sentences[start:start + batch_size], padding=True, truncation=True,
+                                     max_length=self.max_seq_length, return_tensors="np")
+            feeds = {name: encoded[name].astype(np.int64) for name in self.input_names}
+            vecs.append(self.session.run(None, feeds)[0])
+        return np.concatenate(vecs).astype(np.float32)
+
+    def get_max_seq_length(self):
+        return self.max_seq_length
+
+    def set_num_threads(self, num_threads):
+        """
+        Intra-op threads are fixed when an onnxruntime session is created,
+        so the session is created again.
+        """
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(str(self.model_path), options, providers=["CPUExecutionProvider"])
+
+def export_onnx(model_name, model_dir, quantize=True, opset_version=14):
+    """
+    Export a sentence-transformers model to model_dir/model.onnx, and to
+    model_dir/model.int8.onnx with int8 weights if quantize.
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    model_dir = Path(model_dir)
+    model_dir.mkdir(parents=True, exist_ok=True)
+    model = SentenceTransformer(model_name, device="cpu")
+    model.eval()
+
+    dummy = model.tokenizer(["Bertalign"], return_tensors="pt")
+    input_names = list(dummy.keys())
+
+    class _Wrapper(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+
+        def forward(self, *inputs):
+            return self.model(dict(zip(input_names, inputs)))["sentence_embedding"]
+
+    fp32_path = model_dir / "model.onnx"
+    with torch.no_grad():
+        torch.onnx.export(_Wrapper(), tuple(dummy[name] for name in input_names), str(fp32_path),
+                          input_names=input_names,
+                          output_names=["sentence_embedding"],
+                          dynamic_axes={**{name: {0: "batch", 1: "seq"} for name in input_names},
+                                        "sentence_embedding": {0: "batch"}},
+                          opset_version=opset_version)
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(str(fp32_path), str(model_dir / "model.int8.onnx"), weight_type=QuantType.QInt8)
+
+    model.tokenizer.save_pretrained(str(model_dir))
+    with open(model_dir / "bertalign.json", "w", encoding="utf-8") as f:
+        json.dump({"model_name": model_name, "max_seq_length": model.get_max_seq_length()}, f)
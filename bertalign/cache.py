@@ -0,0 +1,260 @@
+import re
+import hashlib
+import sqlite3
+import threading
+import contextlib
+import numpy as np
+
+from pathlib import Path
+from collections import OrderedDict
+
+# sqlite老版本一条语句最多999个参数
+SQL_BATCH = 900
+
+class EmbeddingStore:
+    """
+    Content-addressed embedding store for Encoder.transform.
+    Vectors live in a memory-mapped float32 file, the key -> slot index in sqlite.
+    Keys are the hash of model name plus normalized text, so the same string
+    is never sent to the model twice, across records and across runs.
+    Several handles, also in different processes, can share a directory:
+    every lookup and add runs in one sqlite write transaction and reads the
+    allocation state from the database, not from the handle.
+    """
+    def __init__(self, path, model_name, max_entries=2000000, lru_size=100000):
+        """
+        Args:
+            path: str. Directory of the store, one sub-directory per model.
+            model_name: str. Name of the embedding model.
+            max_entries: int. Maximum number of vectors kept on disk,
+                         least recently used entries are evicted beyond it.
+                         It can grow when an existing store is opened again
+                         but not shrink, ValueError if it is smaller.
+            lru_size: int. Number of vectors kept in the in-process LRU.
+        """
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.lru_size = lru_size
+        self.hits = 0
+        self.misses = 0
+
+        self.dir = Path(path) / re.sub(r'[^\w.-]', '_', model_name)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._lru = OrderedDict()
+        # 事务自己管理，写操作都在BEGIN IMMEDIATE里，多个进程的写者排队
+        self._db = sqlite3.connect(str(self.dir / 'index.sqlite'), timeout=60,
+                                   check_same_thread=False, isolation_level=None)
+        self.dim = None
+        self._next_slot = 0
+        self._capacity = 0
+        self._vecs = None
+        self._clock = 0
+        with self._write():
+            self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS entries (key BLOB PRIMARY KEY, slot INTEGER, used INTEGER)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS entries_used ON entries (used)')
+            # 老版本的库没存max_entries，至少要装得下已经用过的slot
+            stored = self._get_meta('max_entries') or self._get_meta('next_slot') or 0
+            if max_entries < stored:
+                raise ValueError("max_entries {} is smaller than the {} of the store in {}, "
+                                 "entries beyond it would be lost".format(max_entries, stored, self.dir))
+            self._set_meta('max_entries', max_entries)
+            self._sync()
+
+    def lookup(self, texts):
+        """
+        Look up the vectors of texts.
+        Args:
+            texts: list of str.
+        Returns:
+            vecs: numpy array of shape (len(texts), dim), None if the store is empty.
+                  Rows of missing texts are left uninitialized.
+            missing: list of int. Indices of texts not found in the store.
+        """
+        keys = [self.key(text) for text in texts]
+        missing = []
+        with self._lock, self._write():
+            self._sync()
+            if not self.dim:
+                self.misses += len(texts)
+                return None, list(range(len(texts)))
+            vecs = np.empty((len(texts), self.dim), dtype=np.float32)
+            touched = []
+            on_disk = []
+            for i, key in enumerate(keys):
+                vec = self._lru.get(key)
+                if vec is not None:
+                    self._lru.move_to_end(key)
+                    vecs[i] = vec
+                    touched.append((self._clock, key)) # 磁盘上的used也要更新，否则会被先淘汰
+                else:
+                    on_disk.append(i)
+            slots = self._find_slots([keys[i] for i in on_disk])
+            if slots and max(slots.values()) >= self._capacity: # 别的句柄扩过文件
+                self._open(max(slots.values()) + 1)
+            for i in on_disk:
+                slot = slots.get(keys[i])
+                if slot is None:
+                    missing.append(i)
+                    continue
+                vecs[i] = self._vecs[slot]
+                self._remember(keys[i], vecs[i].copy())
+                touched.append((self._clock, keys[i]))
+            if touched:
+                self._db.executemany('UPDATE entries SET used = ? WHERE key = ?', touched)
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+        return vecs, missing
+
+    def add(self, texts, vecs):
+        """
+        Add vectors of texts to the store, evicting old entries if it is full.
+        Args:
+            texts: list of str.
+            vecs: numpy array of shape (len(texts), dim).
+        """
+        vecs = np.asarray(vecs, dtype=np.float32)
+        items = OrderedDict((self.key(text), vec.copy()) for text, vec in zip(texts, vecs))
+        # A batch larger than the store only keeps its tail.
+        items = list(items.items())[-self.max_entries:]
+        with self._lock, self._write():
+            self._sync()
+            if not self.dim:
+                self.dim = vecs.shape[1]
+                self._set_meta('dim', self.dim)
+            new = []
+            touched = []
+            slots = self._find_slots([key for key, _ in items])
+            for key, vec in items:
+                slot = slots.get(key)
+                if slot is None:
+                    new.append((key, vec))
+                else:
+                    self._vecs[slot] = vec
+                    self._remember(key, vec)
+                    touched.append((self._clock, key))
+            self._db.executemany('UPDATE entries SET used = ? WHERE key = ?', touched)
+            slots = self._allocate(len(new))
+            for slot, (key, vec) in zip(slots, new):
+                self._vecs[slot] = vec
+                self._remember(key, vec)
+            self._db.executemany('INSERT INTO entries VALUES (?, ?, ?)',
+                                 [(key, slot, self._clock) for slot, (key, _) in zip(slots, new)])
+            self._set_meta('next_slot', self._next_slot)
+            self._vecs.flush() # 提交之前写到文件，别的句柄一看到key就能读到向量
+
+    def stats(self):
+        """
+        Hit/miss counters since the store was opened.
+        """
+        total = self.hits + self.misses
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    hit_rate=self.hits / total if total else 0.0,
+                    entries=len(self),
+                    lru_entries=len(self._lru))
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def key(self, text):
+        return hashlib.sha1((self.model_name + '\0' + normalize_text(text)).encode('utf-8')).digest()
+
+    def close(self):
+        with self._lock:
+            if self._vecs is not None:
+                self._vecs.flush()
+                self._vecs = None
+            self._db.close()
+
+    @contextlib.contextmanager
+    def _write(self):
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+
+    def _sync(self):
+        """
+        Read the state other handles may have changed, inside a write transaction.
+        The clock is advanced past every used stamp in the store.
+        """
+        self.max_entries = max(self.max_entries, self._get_meta('max_entries') or 0)
+        self._next_slot = self._get_meta('next_slot') or 0
+        self._clock = max(self._clock, self._db.execute('SELECT MAX(used) FROM entries').fetchone()[0] or 0) + 1
+        if not self.dim:
+            self.dim = self._get_meta('dim')
+        if self.dim and self._next_slot > self._capacity:
+            self._open(self._next_slot)
+
+    def _find_slots(self, keys):
+        """
+        Returns:
+            dict of key -> slot for the keys found in the store.
+        """
+        slots = {}
+        for start in range(0, len(keys), SQL_BATCH):
+            batch = keys[start:start + SQL_BATCH]
+            rows = self._db.execute('SELECT key, slot FROM entries WHERE key IN ({})'.format(','.join('?' * len(batch))),
+                                    batch).fetchall()
+            slots.update(rows)
+        return slots
+
+    def _allocate(self, num):
+        """
+        Find num free slots, growing the vector file or evicting the
+        least recently used entries when it is full.
+        """
+        fresh = min(num, self.max_entries - self._next_slot)
+        slots = list(range(self._next_slot, self._next_slot + fresh))
+        self._next_slot += fresh
+        if num > fresh:
+            evicted = self._db.execute('SELECT key, slot FROM entries ORDER BY used LIMIT ?',
+                                       (num - fresh,)).fetchall()
+            self._db.executemany('DELETE FROM entries WHERE key = ?', [(key,) for key, _ in evicted])
+            for key, slot in evicted:
+                self._lru.pop(key, None)
+                slots.append(slot)
+        if self._next_slot > self._capacity:
+            self._open(self._next_slot)
+        return slots
+
+    def _open(self, min_rows):
+        capacity = max(self._capacity, 1024)
+        while capacity < min_rows:
+            capacity *= 2
+        capacity = min(capacity, self.max_entries)
+        path = self.dir / 'vecs.f32'
+        if self._vecs is not None:
+            self._vecs.flush()
+            self._vecs = None
+        with open(path, 'ab') as f:
+            size = capacity * self.dim * 4
+            if f.tell() < size:
+                f.truncate(size)
+        self._vecs = np.memmap(path, dtype=np.float32, mode='r+', shape=(capacity, self.dim))
+        self._capacity = capacity
+
+    def _remember(self, key, vec):
+        if self.lru_size <= 0:
+            return
+        self._lru[key] = vec
+        self._lru.move_to_end(key)
+        if len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def _get_meta(self, key):
+        row = self._db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        self._db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, int(value)))
+
+def normalize_text(text):
+    """去掉首尾空白并把连续空白换成一个空格"""
+    return ' '.join(text.split())
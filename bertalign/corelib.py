@@ -1,14 +1,18 @@
-import torch
-import faiss
 import numpy as np
 import numba as nb
+from numba import types
+from numba.extending import overload
 from sys import platform
 
-def second_back_track(i, j, pointers, search_path, a_types):
+# numba has no float16 on CPU, fp16 embeddings are passed to the kernels
+# as their uint16 bits and decoded through this table.
+HALF_TO_FLOAT = np.arange(65536, dtype=np.uint16).view(np.float16).astype(np.float32)
+
+def second_back_track(i, j, pointers, offsets, search_path, a_types):
     alignment = []
     while ( 1 ):
-        j_offset = j - search_path[i][0]
-        a = pointers[i][j_offset]
+        j_offset = offsets[i] + j - search_path[i][0]
+        a = pointers[j_offset]
         s = a_types[a][0]
         t = a_types[a][1]
         src_range = [i - offset - 1 for offset in range(s)][::-1]
@@ -21,18 +25,23 @@ def second_back_track(i, j, pointers, search_path, a_types):
         if i == 0 and j == 0:
             return alignment[::-1]
 
-@nb.jit(nopython=True, fastmath=True, cache=True)
+@nb.jit(nopython=True, nogil=True, fastmath=True, cache=True)
 def second_pass_align(src_vecs,
                       tgt_vecs,
                       src_lens,
                       tgt_lens,
-                      w,
+                      offsets,
                       search_path,
                       align_types,
                       char_ratio,
                       skip,
                       margin=False,
-                      len_penalty=False):
+                      len_penalty=False,
+                      src_scales=None,
+                      tgt_scales=None,
+                      band=None,
+                      src_margins=None,
+                      tgt_margins=None):
     """
     Perform the second-pass alignment to extract m-n bitext segments.
     Args:
@@ -40,20 +49,30 @@ def second_pass_align(src_vecs,
         tgt_vecs: numpy array of shape (max_align-1, num_tgt_sents, embedding_size).
         src_lens: numpy array of shape (max_align-1, num_src_sents).
         tgt_lens: numpy array of shape (max_align-1, num_tgt_sents).
-        w: int. Predefined window size for the second-pass alignment.
+        offsets: numpy array. Start of each row of the search path in the
+                 flat cost and pointer arrays, from find_second_search_path.
         search_path: numpy array. Second-pass alignment search path.
         align_types: numpy array. Second-pass alignment types.
         char_ratio: float. Source to target length ratio.
         skip: float. Cost for instertion and deletion.
         margin: boolean. True if choosing modified cosine similarity score.
+        src_scales: numpy array of shape (max_align-1, num_src_sents).
+                    Per-vector scales if src_vecs are int8, None otherwise.
+        tgt_scales: numpy array of shape (max_align-1, num_tgt_sents).
+        band: numpy array from compute_band_similarity with the same margin.
+              Similarity scores are read from it instead of computed cell by cell.
+        src_margins: numpy array of shape (max_align-1, num_src_sents).
+        tgt_margins: numpy array of shape (max_align-1, num_tgt_sents).
+                     k-NN margin terms from knn_margins, subtracted from the
+                     similarity if given. Use with margin=False.
     Returns:
-        pointers: numpy array recording best alignments for each DP cell.
+        pointers: numpy array recording best alignments for each DP cell,
+                  cell(i, j) at offsets[i] + j - search_path[i][0].
     """
     # Intialize cost and backpointer matrix
     src_len = src_vecs.shape[1]
-    tgt_len = tgt_vecs.shape[1]
-    cost = np.zeros((src_len + 1, w), dtype=nb.float32)
-    pointers = np.zeros((src_len + 1, w), dtype=nb.uint8)
+    cost = np.zeros(offsets[-1], dtype=nb.float32)
+    pointers = np.zeros(offsets[-1], dtype=nb.uint8)
   
     for i in range(src_len + 1):
         i_start = search_path[i][0]
@@ -61,50 +80,143 @@ def second_pass_align(src_vecs,
         for j in range(i_start, i_end + 1):
             if i + j == 0:
                 continue
-            best_score = -np.inf
-            best_a = -1
-            for a in range(align_types.shape[0]):
-                a_1 = align_types[a][0]
-                a_2 = align_types[a][1]
-                prev_i = i - a_1
-                prev_j = j - a_2
-
-                if prev_i < 0 or prev_j < 0 :  # no previous cell in DP table 
-                    continue
-                prev_i_start = search_path[prev_i][0]
-                prev_i_end =  search_path[prev_i][1]
-                if prev_j < prev_i_start or prev_j > prev_i_end: # out of bound of cost matrix
-                    continue
-                prev_j_offset = prev_j - prev_i_start
-                score = cost[prev_i][prev_j_offset]
-
-                if a_1 == 0 or a_2 == 0:  # deletion or insertion
-                    cur_score = skip
-                else:
-                    cur_score = calculate_similarity_score(src_vecs,
-                                                           tgt_vecs,
-                                                           i, j, a_1, a_2, 
-                                                           src_len, tgt_len,
-                                                           margin=margin)
-                    if len_penalty:
-                        penalty = calculate_length_penalty(src_lens, tgt_lens, i, j,
-                                                           a_1, a_2, char_ratio)
-                        cur_score *= penalty
-        
-                score += cur_score
-                if score > best_score:
-                    best_score = score
-                    best_a = a
-            
             # Update cell(i, j) with the best score
             # and rescord the trace history.
-            j_offset = j - i_start
-            cost[i][j_offset] = best_score
-            pointers[i][j_offset] = best_a
+            j_offset = offsets[i] + j - i_start
+            cost[j_offset], pointers[j_offset] = _second_pass_cell(
+                i, j, cost, offsets, search_path, src_vecs, tgt_vecs, src_lens, tgt_lens, align_types,
+                char_ratio, skip, margin, len_penalty, src_scales, tgt_scales, band, src_margins, tgt_margins)
       
     return pointers
 
-@nb.jit(nopython=True, fastmath=True, cache=True)
+@nb.jit(nopython=True, nogil=True, fastmath=True, cache=True, parallel=True)
+def second_pass_align_parallel(src_vecs,
+                               tgt_vecs,
+                               src_lens,
+                               tgt_lens,
+                               offsets,
+                               search_path,
+                               align_types,
+                               char_ratio,
+                               skip,
+                               margin=False,
+                               len_penalty=False,
+                               src_scales=None,
+                               tgt_scales=None,
+                               band=None,
+                               src_margins=None,
+                               tgt_margins=None,
+                               tile_size=32):
+    """
+    second_pass_align on numba threads, giving the same pointers. The DP
+    table is cut into tiles of tile_size rows by tile_size target columns.
+    Every alignment type moves at least one sentence to the left or up,
+    so a tile only depends on tiles of earlier anti-diagonals of tiles, and
+    the tiles of one anti-diagonal are computed in parallel, each one row
+    by row. The search path must be monotone like the one of
+    find_second_search_path. The number of threads is nb.get_num_threads().
+    A narrow band has few tiles per anti-diagonal, so this pays off for
+    wide bands and costly cells more than for the default window.
+    """
+    src_len = src_vecs.shape[1]
+    cost = np.zeros(offsets[-1], dtype=nb.float32)
+    pointers = np.zeros(offsets[-1], dtype=nb.uint8)
+    tiles = _tile_path(search_path, tile_size)
+    diag_start, diag_end = _diagonal_bounds(tiles)
+
+    for d in range(diag_end[-1] + 1):
+        first_b = np.searchsorted(diag_end, d)
+        last_b = np.searchsorted(diag_start, d, side='right') - 1
+        for b in nb.prange(first_b, last_b + 1):
+            col_start = (d - b) * tile_size
+            col_end = col_start + tile_size
+            for i in range(b * tile_size, min((b + 1) * tile_size, src_len + 1)):
+                i_start = search_path[i][0]
+                for j in range(max(i_start, col_start), min(search_path[i][1] + 1, col_end)):
+                    if i + j == 0:
+                        continue
+                    j_offset = offsets[i] + j - i_start
+                    cost[j_offset], pointers[j_offset] = _second_pass_cell(
+                        i, j, cost, offsets, search_path, src_vecs, tgt_vecs, src_lens, tgt_lens, align_types,
+                        char_ratio, skip, margin, len_penalty, src_scales, tgt_scales, band, src_margins, tgt_margins)
+
+    return pointers
+
+@nb.jit(nopython=True, nogil=True, fastmath=True, cache=True)
+def _tile_path(search_path, tile_size):
+    """
+    Search path of the tiles: the first and last column tile touched by
+    each block of tile_size rows, monotone if search_path is.
+    """
+    num_rows = search_path.shape[0]
+    num_tiles = (num_rows + tile_size - 1) // tile_size
+    tiles = np.empty((num_tiles, 2), dtype=np.int64)
+    for b in range(num_tiles):
+        tiles[b, 0] = search_path[b * tile_size][0] // tile_size
+        tiles[b, 1] = search_path[min((b + 1) * tile_size, num_rows) - 1][1] // tile_size
+    return tiles
+
+@nb.jit(nopython=True, nogil=True, fastmath=True, cache=True)
+def _diagonal_bounds(search_path):
+    """
+    Row i has the cells of the anti-diagonals diag_start[i] .. diag_end[i],
+    both increasing with i for a monotone search path, so the rows of an
+    anti-diagonal are found by binary search. Works on tile paths as well.
+    """
+    rows = np.arange(search_path.shape[0])
+    return search_path[:, 0] + rows, search_path[:, 1] + rows
+
+@nb.jit(nopython=True, nogil=True, fastmath=True, cache=True)
+def _second_pass_cell(i, j, cost, offsets, search_path, src_vecs, tgt_vecs, src_lens, tgt_lens, align_types,
+                      char_ratio, skip, margin, len_penalty, src_scales, tgt_scales, band, src_margins, tgt_margins):
+    """Best score and alignment type of cell(i, j) of second_pass_align."""
+    src_len = src_vecs.shape[1]
+    tgt_len = tgt_vecs.shape[1]
+    i_start = search_path[i][0]
+    best_score = -np.inf
+    best_a = -1
+    for a in range(align_types.shape[0]):
+        a_1 = align_types[a][0]
+        a_2 = align_types[a][1]
+        prev_i = i - a_1
+        prev_j = j - a_2
+
+        if prev_i < 0 or prev_j < 0 :  # no previous cell in DP table 
+            continue
+        prev_i_start = search_path[prev_i][0]
+        prev_i_end =  search_path[prev_i][1]
+        if prev_j < prev_i_start or prev_j > prev_i_end: # out of bound of cost matrix
+            continue
+        prev_j_offset = offsets[prev_i] + prev_j - prev_i_start
+        score = cost[prev_j_offset]
+
+        if a_1 == 0 or a_2 == 0:  # deletion or insertion
+            cur_score = skip
+        else:
+            if band is not None:
+                cur_score = band[a, offsets[i] + j - i_start]
+            else:
+                cur_score = calculate_similarity_score(src_vecs,
+                                                       tgt_vecs,
+                                                       i, j, a_1, a_2, 
+                                                       src_len, tgt_len,
+                                                       margin=margin,
+                                                       src_scales=src_scales,
+                                                       tgt_scales=tgt_scales)
+            if src_margins is not None:
+                cur_score -= (src_margins[a_1 - 1, i - 1] + tgt_margins[a_2 - 1, j - 1]) / 2
+            if len_penalty:
+                penalty = calculate_length_penalty(src_lens, tgt_lens, i, j,
+                                                   a_1, a_2, char_ratio)
+                cur_score *= penalty
+
+        score += cur_score
+        if score > best_score:
+            best_score = score
+            best_a = a
+    return best_score, best_a
+
+@nb.jit(nopython=True, nogil=True, fastmath=True, cache=True)
 def calculate_similarity_score(src_vecs,
                                tgt_vecs,
                                src_idx,
@@ -113,7 +225,9 @@ def calculate_similarity_score(src_vecs,
                                tgt_overlap,
                                src_len,
                                tgt_len,
-                               margin=False):
+                               margin=False,
+                               src_scales=None,
+                               tgt_scales=None):
   
     """
     Calulate the semantics-based similarity score of bitext segment.
@@ -121,38 +235,72 @@ def calculate_similarity_score(src_vecs,
     src_v = src_vecs[src_overlap - 1, src_idx - 1, :]
     tgt_v = tgt_vecs[tgt_overlap - 1, tgt_idx - 1, :]
     similarity = nb_dot(src_v, tgt_v)
+    if src_scales is not None:
+        similarity *= src_scales[src_overlap - 1, src_idx - 1] * tgt_scales[tgt_overlap - 1, tgt_idx - 1]
     if margin:
-        tgt_neighbor_ave_sim = calculate_neighbor_similarity(src_v, 
-                                                             tgt_overlap,
-                                                             tgt_idx,
-                                                             tgt_len,
-                                                             tgt_vecs)
-    
-        src_neighbor_ave_sim = calculate_neighbor_similarity(tgt_v,
-                                                             src_overlap,
-                                                             src_idx,
-                                                             src_len,
-                                                             src_vecs)
-    
-        neighbor_ave_sim = (tgt_neighbor_ave_sim + src_neighbor_ave_sim) / 2
-        similarity -= neighbor_ave_sim
+        similarity -= calculate_margin(src_vecs, tgt_vecs, src_idx, tgt_idx, src_overlap, tgt_overlap,
+                                       src_len, tgt_len, src_scales, tgt_scales)
 
     return similarity
 
-@nb.jit(nopython=True, fastmath=True, cache=True)
-def calculate_neighbor_similarity(vec, overlap, sent_idx, sent_len, db):
+@nb.jit(nopython=True, nogil=True, fastmath=True, cache=True)
+def calculate_margin(src_vecs,
+                     tgt_vecs,
+                     src_idx,
+                     tgt_idx,
+                     src_overlap,
+                     tgt_overlap,
+                     src_len,
+                     tgt_len,
+                     src_scales=None,
+                     tgt_scales=None):
+    """
+    Average similarity of the bitext segment to the neighbouring sentences,
+    subtracted from its similarity for the modified cosine similarity score.
+    """
+    src_v = src_vecs[src_overlap - 1, src_idx - 1, :]
+    tgt_v = tgt_vecs[tgt_overlap - 1, tgt_idx - 1, :]
+    src_s = 1.0
+    tgt_s = 1.0
+    if src_scales is not None:
+        src_s = src_scales[src_overlap - 1, src_idx - 1]
+        tgt_s = tgt_scales[tgt_overlap - 1, tgt_idx - 1]
+    tgt_neighbor_ave_sim = calculate_neighbor_similarity(src_v, 
+                                                         tgt_overlap,
+                                                         tgt_idx,
+                                                         tgt_len,
+                                                         tgt_vecs,
+                                                         src_s,
+                                                         tgt_scales)
+
+    src_neighbor_ave_sim = calculate_neighbor_similarity(tgt_v,
+                                                         src_overlap,
+                                                         src_idx,
+                                                         src_len,
+                                                         src_vecs,
+                                                         tgt_s,
+                                                         src_scales)
+
+    return (tgt_neighbor_ave_sim + src_neighbor_ave_sim) / 2
+
+@nb.jit(nopython=True, nogil=True, fastmath=True, cache=True)
+def calculate_neighbor_similarity(vec, overlap, sent_idx, sent_len, db, vec_scale=1.0, db_scales=None):
     left_idx = sent_idx - overlap
     right_idx = sent_idx + 1
     
     if right_idx <= sent_len:
         right_embed = db[0, right_idx - 1, :]
         neighbor_right_sim = nb_dot(vec, right_embed)
+        if db_scales is not None:
+            neighbor_right_sim *= vec_scale * db_scales[0, right_idx - 1]
     else:
         neighbor_right_sim = 0
  
     if left_idx > 0:
         left_embed = db[0, left_idx - 1, :]
         neighbor_left_sim = nb_dot(vec, left_embed)
+        if db_scales is not None:
+            neighbor_left_sim *= vec_scale * db_scales[0, left_idx - 1]
     else:
         neighbor_left_sim = 0
     
@@ -162,7 +310,7 @@ def calculate_neighbor_similarity(vec, overlap, sent_idx, sent_len, db):
     
     return neighbor_ave_sim
 
-@nb.jit(nopython=True, fastmath=True, cache=True)
+@nb.jit(nopython=True, nogil=True, fastmath=True, cache=True)
 def calculate_length_penalty(src_lens,
                              tgt_lens,
                              src_idx,
@@ -191,9 +339,271 @@ def calculate_length_penalty(src_lens,
     length_penalty = np.log2(1 + min_len / max_len)
     return length_penalty
 
-@nb.jit(nopython=True, fastmath=True, cache=True)
+@nb.jit(nopython=True, nogil=True, fastmath=True, cache=True)
+def score_beads(src_vecs,
+                tgt_vecs,
+                src_lens,
+                tgt_lens,
+                src_end,
+                tgt_end,
+                src_overlap,
+                tgt_overlap,
+                char_ratio,
+                skip,
+                margin=False,
+                len_penalty=False,
+                src_scales=None,
+                tgt_scales=None,
+                src_margins=None,
+                tgt_margins=None):
+    """
+    Score the beads of the final alignment the way second_pass_align scores
+    them, so that only the best path is scored and no DP cell keeps its score.
+    Args:
+        src_end: numpy array. End (exclusive) source sentence index of each bead.
+        tgt_end: numpy array. End (exclusive) target sentence index of each bead.
+        src_overlap: numpy array. Number of source sentences in each bead.
+        tgt_overlap: numpy array. Number of target sentences in each bead.
+        The other arguments are the same as second_pass_align.
+    Returns:
+        scores: numpy array. DP score of each bead, skip for insertions and deletions.
+        similarity: numpy array. Cosine similarity of each bead, nan for insertions and deletions.
+        margins: numpy array. Similarity minus the average similarity to the
+                 neighbouring sentences if margin, minus the k-NN margin if
+                 src_margins and tgt_margins are given, else the similarity itself,
+                 nan for insertions and deletions.
+    """
+    src_len = src_vecs.shape[1]
+    tgt_len = tgt_vecs.shape[1]
+    num_beads = src_end.shape[0]
+    scores = np.full(num_beads, skip, dtype=np.float32)
+    similarity = np.full(num_beads, np.nan, dtype=np.float32)
+    margins = np.full(num_beads, np.nan, dtype=np.float32)
+    for k in range(num_beads):
+        a_1 = src_overlap[k]
+        a_2 = tgt_overlap[k]
+        if a_1 == 0 or a_2 == 0:
+            continue
+        i = src_end[k]
+        j = tgt_end[k]
+        sim = calculate_similarity_score(src_vecs, tgt_vecs, i, j, a_1, a_2, src_len, tgt_len,
+                                         margin=False, src_scales=src_scales, tgt_scales=tgt_scales)
+        cur_score = sim
+        if margin:
+            cur_score = calculate_similarity_score(src_vecs, tgt_vecs, i, j, a_1, a_2, src_len, tgt_len,
+                                                   margin=True, src_scales=src_scales, tgt_scales=tgt_scales)
+        elif src_margins is not None:
+            cur_score = sim - (src_margins[a_1 - 1, i - 1] + tgt_margins[a_2 - 1, j - 1]) / 2
+        margins[k] = cur_score
+        if len_penalty:
+            cur_score *= calculate_length_penalty(src_lens, tgt_lens, i, j, a_1, a_2, char_ratio)
+        similarity[k] = sim
+        scores[k] = cur_score
+    return scores, similarity, margins
+
+@nb.jit(nopython=True, nogil=True, fastmath=True, cache=True)
 def nb_dot(x, y):
-    return np.dot(x,y)
+    return vec_dot(x, y)
+
+def vec_dot(x, y):
+    """
+    Dot product of two embeddings stored as float32, fp16 bits (uint16) or int8.
+    int8 products are not scaled here, see compress_vecs.
+    """
+    return np.dot(decompress_vecs(x), decompress_vecs(y))
+
+@overload(vec_dot, jit_options={'fastmath': True})
+def _vec_dot(x, y):
+    if x.dtype == types.uint16:
+        def impl(x, y):
+            s = np.float32(0)
+            for k in range(x.shape[0]):
+                s += HALF_TO_FLOAT[x[k]] * HALF_TO_FLOAT[y[k]]
+            return s
+    elif x.dtype == types.int8:
+        def impl(x, y):
+            s = np.int32(0)
+            for k in range(x.shape[0]):
+                s += np.int32(x[k]) * np.int32(y[k])
+            return np.float32(s)
+    else:
+        def impl(x, y):
+            return np.dot(x, y)
+    return impl
+
+def compress_vecs(vecs, dtype="float32"):
+    """
+    Store embeddings in a smaller dtype for the DP.
+    Args:
+        vecs: numpy array of float32 embeddings, the last axis being the embedding.
+        dtype: str. "float32", "float16" or "int8".
+    Returns:
+        vecs: float32 as is, float16 viewed as uint16, or int8 with one scale per vector.
+        scales: numpy array of shape vecs.shape[:-1] for int8, None otherwise.
+    """
+    if dtype == "float32":
+        return vecs, None
+    if dtype == "float16":
+        return vecs.astype(np.float16).view(np.uint16), None
+    if dtype == "int8":
+        scales = np.abs(vecs).max(axis=-1) / 127
+        scales[scales == 0] = 1
+        vecs = np.rint(vecs / scales[..., None]).astype(np.int8)
+        return vecs, scales.astype(np.float32)
+    raise Exception('Unknown vector dtype {}'.format(dtype))
+
+def compute_band_similarity(src_vecs,
+                            tgt_vecs,
+                            offsets,
+                            search_path,
+                            align_types,
+                            margin=False,
+                            src_scales=None,
+                            tgt_scales=None,
+                            block_size=None):
+    """
+    Precompute the similarity scores second_pass_align needs with a few
+    matrix products per block of source rows, instead of dot products per
+    DP cell and alignment type. The search path is monotone, so a block of
+    rows only needs the target columns between its first lower bound and
+    its last upper bound, and all overlap layers are multiplied at once.
+    With margin, the similarities to the neighbouring sentences come from
+    the same products against layer 0 of the other side, so the band holds
+    the modified cosine similarity of calculate_similarity_score.
+    Args:
+        src_vecs, tgt_vecs, offsets, search_path, align_types, margin, src_scales, tgt_scales:
+            same as second_pass_align.
+        block_size: int. Number of source rows per matrix product, about
+                    half the widest row by default so few products are wasted.
+    Returns:
+        band: numpy array of shape (num_align_types, offsets[-1]).
+              band[a, offsets[i] + j - search_path[i][0]] is the score of the a-th
+              alignment type ending at source sentence i and target
+              sentence j, 0 for insertions and deletions.
+    """
+    num_layers, src_len, dim = src_vecs.shape
+    tgt_len = tgt_vecs.shape[1]
+    widths = search_path[:, 1] - search_path[:, 0] + 1
+    if block_size is None:
+        block_size = max(32, widths.max() // 2)
+    band = np.zeros((len(align_types), offsets[-1]), dtype=np.float32)
+    types = np.nonzero((align_types[:, 0] > 0) & (align_types[:, 1] > 0))[0]
+    for start in range(1, src_len + 1, block_size):
+        end = min(start + block_size, src_len + 1)
+        lower = search_path[start:end, 0]
+        upper = search_path[start:end, 1]
+        j_start = max(lower[0], 1)
+        j_end = upper[-1]
+        if j_end < j_start:
+            continue
+        src_block = _decompress_range(src_vecs, src_scales, start - 1, end - 1)
+        tgt_block = _decompress_range(tgt_vecs, tgt_scales, j_start - 1, j_end)
+        num_rows, span = end - start, j_end - j_start + 1
+        sims = (src_block.reshape(-1, dim) @ tgt_block.reshape(-1, dim).T).reshape(num_layers, num_rows, num_layers, span)
+        i = np.arange(start, end)[:, None]
+        # the rows of a block are consecutive in band, padded to the widest one here
+        j = lower[:, None] + np.arange(widths[start:end].max())[None, :]
+        in_row = j <= upper[:, None]
+        valid = (j >= 1) & in_row
+        col = np.clip(j - j_start, 0, span - 1)
+        if margin:
+            # layer 0 of the neighbours: source i - num_layers - 1 .. end - 1, target j_start - num_layers - 1 .. j_end
+            src_lo, src_hi = max(start - num_layers - 1, 0), min(end, src_len)
+            tgt_lo, tgt_hi = max(j_start - num_layers - 1, 0), min(j_end + 1, tgt_len)
+            src_neighbors = _decompress_range(src_vecs[:1], None if src_scales is None else src_scales[:1], src_lo, src_hi)[0]
+            tgt_neighbors = _decompress_range(tgt_vecs[:1], None if tgt_scales is None else tgt_scales[:1], tgt_lo, tgt_hi)[0]
+            src_sims = (src_block.reshape(-1, dim) @ tgt_neighbors.T).reshape(num_layers, num_rows, -1)
+            tgt_sims = (tgt_block.reshape(-1, dim) @ src_neighbors.T).reshape(num_layers, span, -1)
+            # neighbours at shift -num_layers - 1 .. 0 from each cell, the right
+            # neighbour is the last one and the left neighbour of a segment of
+            # k sentences is at shift -k - 1
+            shifts = np.arange(-num_layers - 1, 1)
+            rows = np.arange(num_rows)[:, None, None]
+            tgt_idx = np.clip(j[:, :, None] + shifts - tgt_lo, 0, tgt_hi - tgt_lo - 1)
+            src_idx = np.clip(i[:, :, None] + shifts - src_lo, 0, src_hi - src_lo - 1)
+            tgt_shifted = src_sims[:, rows, tgt_idx]
+            src_shifted = tgt_sims[:, col[:, :, None], src_idx]
+            tgt_right = np.where(j + 1 <= tgt_len, tgt_shifted[..., -1], 0)
+            src_right = np.where(i + 1 <= src_len, src_shifted[..., -1], 0)
+        for a in types:
+            a_1, a_2 = align_types[a]
+            score = np.take_along_axis(sims[a_1 - 1, :, a_2 - 1, :], col, axis=1)
+            if margin:
+                tgt_left = np.where(j - a_2 > 0, tgt_shifted[a_1 - 1, ..., num_layers - a_2], 0)
+                src_left = np.where(i - a_1 > 0, src_shifted[a_2 - 1, ..., num_layers - a_1], 0)
+                score -= (_neighbor_average(tgt_left, tgt_right[a_1 - 1]) + _neighbor_average(src_left, src_right[a_2 - 1])) / 2
+            band[a, offsets[start]:offsets[end]] = np.where(valid, score, 0)[in_row]
+    return band
+
+def _decompress_range(vecs, scales, start, end):
+    return decompress_vecs(vecs[:, start:end], None if scales is None else scales[:, start:end])
+
+def _neighbor_average(left, right):
+    """Average like calculate_neighbor_similarity, a missing neighbour counts as 0."""
+    both = (left != 0) & (right != 0)
+    return np.where(both, (left + right) / 2, left + right)
+
+def knn_margins(src_vecs, tgt_vecs, k=4, src_scales=None, tgt_scales=None):
+    """
+    Margin terms of the k-nearest-neighbour margin score: the mean similarity
+    of every overlap vector to its k nearest single sentences on the other
+    side, found with faiss. second_pass_align subtracts
+    (src_margins[src_overlap - 1, src_idx - 1] + tgt_margins[tgt_overlap - 1, tgt_idx - 1]) / 2.
+    Returns:
+        src_margins: numpy array of shape (max_align-1, num_src_sents).
+        tgt_margins: numpy array of shape (max_align-1, num_tgt_sents).
+    """
+    src_vecs = decompress_vecs(src_vecs, src_scales)
+    tgt_vecs = decompress_vecs(tgt_vecs, tgt_scales)
+    margins = []
+    for vecs, db in ((src_vecs, tgt_vecs[0]), (tgt_vecs, src_vecs[0])):
+        D, _ = find_top_k_sents(np.ascontiguousarray(vecs.reshape(-1, vecs.shape[-1])), np.ascontiguousarray(db),
+                                k=min(k, len(db)))
+        margins.append(D.mean(axis=1).astype(np.float32).reshape(vecs.shape[:2]))
+    return tuple(margins)
+
+def paragraph_embeddings(vecs, lens, bounds, num_overlaps):
+    """
+    Embed paragraphs, and windows of up to num_overlaps consecutive paragraphs,
+    as the normalized sum of their sentence embeddings.
+    Args:
+        vecs: numpy array of shape (num_sents, embedding_size). Sentence embeddings.
+        lens: numpy array of shape (num_sents,). Sentence lengths.
+        bounds: numpy array of shape (num_paragraphs + 1,). First sentence of
+                each paragraph and num_sents, no paragraph is empty.
+        num_overlaps: int. Maximum number of paragraphs in a window.
+    Returns:
+        vecs: numpy array of shape (num_overlaps, num_paragraphs, embedding_size).
+        lens: numpy array of shape (num_overlaps, num_paragraphs).
+        The same layout as Encoder.transform, PAD windows are zero.
+    """
+    num_paras = len(bounds) - 1
+    para_vecs = np.add.reduceat(vecs, bounds[:-1], axis=0, dtype=np.float64)
+    cum_vecs = np.concatenate([np.zeros((1, vecs.shape[1])), np.cumsum(para_vecs, axis=0)])
+    cum_lens = np.concatenate([[0], np.cumsum(lens)])
+    out_vecs = np.zeros((num_overlaps, num_paras, vecs.shape[1]), dtype=np.float32)
+    out_lens = np.full((num_overlaps, num_paras), len('PAD'), dtype=np.int64)
+    for layer in range(min(num_overlaps, num_paras)):
+        ends = np.arange(layer, num_paras)
+        window = cum_vecs[ends + 1] - cum_vecs[ends - layer]
+        norms = np.linalg.norm(window, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        out_vecs[layer, ends] = window / norms
+        # 句子之间用空格连接
+        first, last = bounds[ends - layer], bounds[ends + 1]
+        out_lens[layer, ends] = cum_lens[last] - cum_lens[first] + last - first - 1
+    return out_vecs, out_lens
+
+def decompress_vecs(vecs, scales=None):
+    """
+    Inverse of compress_vecs, returns float32 embeddings.
+    """
+    if vecs.dtype == np.uint16:
+        return vecs.view(np.float16).astype(np.float32)
+    vecs = vecs.astype(np.float32)
+    if scales is not None:
+        vecs *= scales[..., None]
+    return vecs
 
 def find_second_search_path(align, w, src_len, tgt_len):
     """
@@ -205,6 +615,8 @@ def find_second_search_path(align, w, src_len, tgt_len):
         src_len: int. Number of source sentences.
         tgt_len: int. Number of target sentences.
     Returns:
+        offsets: numpy array of shape (src_len + 2,). Start of each row of
+                 the path in the flat DP arrays, offsets[-1] being their size.
         path: numpy array. Search path for the second-pass alignment.
     """
     # Ajust the first-alignment result
@@ -225,7 +637,6 @@ def find_second_search_path(align, w, src_len, tgt_len):
     """
     prev_src, prev_tgt = 0, 0
     path = []
-    max_w = -np.inf
     for src, tgt in align:
         # Limit the search path in a rectangle with the width
         # along the Y axis being (upper_bound - lower_bound).
@@ -233,11 +644,11 @@ def find_second_search_path(align, w, src_len, tgt_len):
         upper_bound = min(tgt_len, tgt + w)
         path.extend([(lower_bound, upper_bound) for id in range(prev_src+1, src+1)])
         prev_src, prev_tgt = src, tgt
-        width = upper_bound - lower_bound
-        if width > max_w:
-            max_w = width
     path = [path[0]] + path # add the search path for row 0
-    return max_w + 1, np.array(path)
+    path = np.array(path)
+    offsets = np.zeros(len(path) + 1, dtype=np.int64)
+    np.cumsum(path[:, 1] - path[:, 0] + 1, out=offsets[1:])
+    return offsets, path
 
 def first_back_track(i, j, pointers, search_path, a_types):
     """
@@ -266,7 +677,98 @@ def first_back_track(i, j, pointers, search_path, a_types):
         if i == 0 and j == 0: # if reaching the origin
             return alignment[::-1]
 
-@nb.jit(nopython=True, fastmath=True, cache=True)
+@nb.jit(nopython=True, nogil=True, fastmath=True, cache=True)
+def chain_anchors(tgt_len, dist, index):
+    """
+    Sparse alternative to first_pass_align and first_back_track: the chain
+    of top-k candidates strictly increasing in both source and target index
+    with the highest total similarity, which is what the first-pass DP
+    maximizes without its window. Weighted longest increasing subsequence
+    with a Fenwick tree of prefix maxima over target positions, so it runs
+    in O(n * k * log(tgt_len)).
+    Args:
+        tgt_len: int. Number of target sentences.
+        dist: numpy array. Distance matrix for top-k similar vecs.
+        index: numpy array. Index matrix for top-k similar vecs, candidates
+               outside [0, tgt_len) are ignored.
+    Returns:
+        anchors: numpy array of shape (num_anchors, 2), the 1-1 alignments
+                 (i, j) counted from 1 like first_back_track.
+    """
+    src_len, top_k = index.shape
+    # tree[q] covers target positions (q - (q & -q), q], counted from 1
+    tree_score = np.zeros(tgt_len + 1, dtype=nb.float32)
+    tree_id = np.full(tgt_len + 1, -1, dtype=nb.int64)
+    score = np.zeros(src_len * top_k, dtype=nb.float32)
+    prev = np.full(src_len * top_k, -1, dtype=nb.int64)
+    best_score = 0.0
+    best_id = -1
+    for i in range(src_len):
+        # query every candidate of the row before adding any, so that two
+        # candidates of the same source sentence are never chained
+        for k in range(top_k):
+            j = index[i][k]
+            if j < 0 or j >= tgt_len or dist[i][k] <= 0:
+                continue
+            c = i * top_k + k
+            q = j
+            while q > 0:
+                if tree_score[q] > score[c]:
+                    score[c] = tree_score[q]
+                    prev[c] = tree_id[q]
+                q -= q & -q
+            score[c] += dist[i][k]
+        for k in range(top_k):
+            c = i * top_k + k
+            if score[c] <= 0:
+                continue
+            q = index[i][k] + 1
+            while q <= tgt_len:
+                if score[c] > tree_score[q]:
+                    tree_score[q] = score[c]
+                    tree_id[q] = c
+                q += q & -q
+            if score[c] > best_score:
+                best_score = score[c]
+                best_id = c
+
+    num_anchors = 0
+    c = best_id
+    while c >= 0:
+        num_anchors += 1
+        c = prev[c]
+    anchors = np.zeros((num_anchors, 2), dtype=nb.int64)
+    c = best_id
+    for n in range(num_anchors - 1, -1, -1):
+        anchors[n, 0] = c // top_k + 1
+        anchors[n, 1] = index[c // top_k][c % top_k] + 1
+        c = prev[c]
+    return anchors
+
+def find_cut_anchor(alignment, index, lo, hi):
+    """
+    Pick a first-pass anchor to cut the document at.
+    An anchor is confident if it is the top-1 faiss match of its source
+    sentence and its neighbours on both sides are 1-1 alignments too.
+    Args:
+        alignment: list of tuples. First-pass alignment results.
+        index: numpy array. Index matrix for top-k similar vecs.
+        lo: int. Smallest source position to cut at.
+        hi: int. Largest source position to cut at.
+    Returns:
+        anchor: tuple. The last confident anchor in [lo, hi], None if there is none.
+    """
+    beads = set(alignment)
+    for i, j in reversed(alignment):
+        if i > hi:
+            continue
+        if i < lo:
+            break
+        if index[i - 1][0] == j - 1 and (i - 1, j - 1) in beads and (i + 1, j + 1) in beads:
+            return (i, j)
+    return None
+
+@nb.jit(nopython=True, nogil=True, fastmath=True, cache=True)
 def first_pass_align(src_len,
                      tgt_len,
                      w,
@@ -291,8 +793,6 @@ def first_pass_align(src_len,
     # Initialize cost and backpointer matrix.
     cost = np.zeros((src_len + 1, 2 * w + 1), dtype=nb.float32)
     pointers = np.zeros((src_len + 1, 2 * w + 1), dtype=nb.uint8)
-  
-    top_k = index.shape[1]
 
     for i in range(src_len + 1):
         i_start = search_path[i][0]
@@ -300,39 +800,78 @@ def first_pass_align(src_len,
         for j in range(i_start, i_end + 1):
             if i + j == 0: # initialize the origin with zero
                 continue
-            best_score = -np.inf
-            best_a = -1
-            for a in range(align_types.shape[0]):
-                a_1 = align_types[a][0]
-                a_2 = align_types[a][1]
-                prev_i = i - a_1
-                prev_j = j - a_2
-                if prev_i < 0 or prev_j < 0 :  # no previous cell 
-                    continue
-                prev_i_start = search_path[prev_i][0]
-                prev_i_end =  search_path[prev_i][1]
-                if prev_j < prev_i_start or prev_j > prev_i_end: # out of bound of cost matrix
-                    continue
-                prev_j_offset = prev_j - prev_i_start
-                score = cost[prev_i][prev_j_offset]
-                
-                # Extract the score for 1-1 bead from faiss.
-                if a_1 > 0 and a_2 > 0:
-                    for k in range(top_k):
-                        if index[i-1][k] == j - 1:
-                            score += dist[i-1][k]
-                if score > best_score:
-                    best_score = score
-                    best_a = a
-            
             # Update cell(i, j) with the best score
             # and rescord the trace history.
             j_offset = j - i_start
-            cost[i][j_offset] = best_score
-            pointers[i][j_offset] = best_a
+            cost[i][j_offset], pointers[i][j_offset] = _first_pass_cell(i, j, cost, search_path, align_types, dist, index)
+
+    return pointers
+
+@nb.jit(nopython=True, nogil=True, fastmath=True, cache=True, parallel=True)
+def first_pass_align_parallel(src_len,
+                              tgt_len,
+                              w,
+                              search_path,
+                              align_types,
+                              dist,
+                              index,
+                              tile_size=32
+                              ):
+    """
+    first_pass_align on numba threads one anti-diagonal of tiles at a time,
+    giving the same pointers, see second_pass_align_parallel.
+    """
+    cost = np.zeros((src_len + 1, 2 * w + 1), dtype=nb.float32)
+    pointers = np.zeros((src_len + 1, 2 * w + 1), dtype=nb.uint8)
+    tiles = _tile_path(search_path, tile_size)
+    diag_start, diag_end = _diagonal_bounds(tiles)
+
+    for d in range(diag_end[-1] + 1):
+        first_b = np.searchsorted(diag_end, d)
+        last_b = np.searchsorted(diag_start, d, side='right') - 1
+        for b in nb.prange(first_b, last_b + 1):
+            col_start = (d - b) * tile_size
+            col_end = col_start + tile_size
+            for i in range(b * tile_size, min((b + 1) * tile_size, src_len + 1)):
+                i_start = search_path[i][0]
+                for j in range(max(i_start, col_start), min(search_path[i][1] + 1, col_end)):
+                    if i + j == 0:
+                        continue
+                    j_offset = j - i_start
+                    cost[i][j_offset], pointers[i][j_offset] = _first_pass_cell(i, j, cost, search_path, align_types, dist, index)
 
     return pointers
 
+@nb.jit(nopython=True, nogil=True, fastmath=True, cache=True)
+def _first_pass_cell(i, j, cost, search_path, align_types, dist, index):
+    """Best score and alignment type of cell(i, j) of first_pass_align."""
+    top_k = index.shape[1]
+    best_score = -np.inf
+    best_a = -1
+    for a in range(align_types.shape[0]):
+        a_1 = align_types[a][0]
+        a_2 = align_types[a][1]
+        prev_i = i - a_1
+        prev_j = j - a_2
+        if prev_i < 0 or prev_j < 0 :  # no previous cell 
+            continue
+        prev_i_start = search_path[prev_i][0]
+        prev_i_end =  search_path[prev_i][1]
+        if prev_j < prev_i_start or prev_j > prev_i_end: # out of bound of cost matrix
+            continue
+        prev_j_offset = prev_j - prev_i_start
+        score = cost[prev_i][prev_j_offset]
+        
+        # Extract the score for 1-1 bead from faiss.
+        if a_1 > 0 and a_2 > 0:
+            for k in range(top_k):
+                if index[i-1][k] == j - 1:
+                    score += dist[i-1][k]
+        if score > best_score:
+            best_score = score
+            best_a = a
+    return best_score, best_a
+
 def find_first_search_path(src_len: int,
                            tgt_len: int,
                            min_win_size = 250, # 250可能不是很适合段落对齐
@@ -378,6 +917,38 @@ def get_alignment_types(max_alignment_size):
                 alignment_types.append([x, y])    
     return np.array(alignment_types)
 
+def is_near_diagonal(src_vecs, tgt_vecs, min_ratio=0.95, max_run=None):
+    """
+    Check whether two documents with the same number of sentences are
+    aligned 1-1 almost everywhere: sentence i of the source must be at least
+    as similar to sentence i of the target as to its neighbours i-1 and i+1
+    for min_ratio of the sentences. Costs O(n) dot products instead of a
+    nearest neighbour search.
+    Args:
+        src_vecs: numpy array of shape (num_sents, embedding_size).
+        tgt_vecs: numpy array of shape (num_sents, embedding_size).
+        min_ratio: float. Fraction of sentences the diagonal must win.
+        max_run: int. Longest run of consecutive sentences the diagonal may
+                 lose, a longer run is a local shift that a band of this
+                 width around the diagonal cannot follow. Not checked if None.
+    """
+    if len(src_vecs) != len(tgt_vecs) or len(src_vecs) < 2:
+        return False
+    diag = np.einsum('ij,ij->i', src_vecs, tgt_vecs)
+    upper = np.einsum('ij,ij->i', src_vecs[:-1], tgt_vecs[1:])
+    lower = np.einsum('ij,ij->i', src_vecs[1:], tgt_vecs[:-1])
+    wins = np.ones(len(diag), dtype=bool)
+    wins[:-1] &= diag[:-1] >= upper
+    wins[1:] &= diag[1:] >= lower
+    if wins.mean() < min_ratio:
+        return False
+    if max_run is not None:
+        # 相邻的输赢边界之间就是一段连续输掉的句子
+        edges = np.flatnonzero(np.diff(np.concatenate([[True], wins, [True]]).astype(np.int8)))
+        if len(edges) and (edges[1::2] - edges[::2]).max() > max_run:
+            return False
+    return True
+
 def find_top_k_sents(src_vecs, tgt_vecs, k=3):
     """
     Find the top_k similar vecs in tgt_vecs for each vec in src_vecs.
@@ -389,8 +960,9 @@ def find_top_k_sents(src_vecs, tgt_vecs, k=3):
         D: numpy array. Similarity score matrix of shape (num_src_sents, k).
         I: numpy array. Target index matrix of shape (num_src_sents, k).
     """
+    import faiss
     embedding_size = src_vecs.shape[1]
-    if torch.cuda.is_available() and platform == 'linux': # GPU version
+    if platform == 'linux' and hasattr(faiss, 'StandardGpuResources') and faiss.get_num_gpus() > 0: # GPU version
         res = faiss.StandardGpuResources() 
         index = faiss.IndexFlatIP(embedding_size)
         gpu_index = faiss.index_cpu_to_gpu(res, 0, index)
@@ -1,24 +1,208 @@
 import numpy as np
 
-from sentence_transformers import SentenceTransformer
-from bertalign.utils import yield_overlaps
+from bertalign.utils import yield_overlaps, overlap_lengths
+
+# transform_many每次送给编码器的不同字符串个数
+ENCODE_CHUNK = 4096
 
 class Encoder:
-    def __init__(self, model_name):
-        self.model = SentenceTransformer(model_name)
+    def __init__(self, model_name, device=None, backend="torch", store=None, max_tokens=8192, max_batch_size=256):
+        """
+        The model is loaded on first use.
+        Args:
+            model_name: str. Name of the sentence-transformers model.
+            device: str. Torch device of the model, e.g. "cpu" or "cuda:1",
+                    picked by sentence-transformers if None.
+            backend: str or object. "torch" for sentence-transformers, "onnx" for
+                     int8 ONNX Runtime on CPU, "onnx-fp32" for fp32 ONNX Runtime,
+                     or any object with encode(sentences, batch_size),
+                     tokenizer and get_max_seq_length() like SentenceTransformer.
+            store: EmbeddingStore. Optional on-disk cache of embeddings,
+                   strings found in it are not sent to the model again.
+            max_tokens: int. Token budget of one batch, short sentences
+                        are batched together more than long ones.
+            max_batch_size: int. Upper bound of the batch size.
+        """
         self.model_name = model_name
+        self.device = device
+        self.backend = backend
+        self._model = None if isinstance(backend, str) else backend
+        self.store = store
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.pool = None
+        self._dim = None
+
+    @property
+    def model(self):
+        if self._model is None:
+            if self.backend == "torch":
+                from sentence_transformers import SentenceTransformer
+                self._model = SentenceTransformer(self.model_name, device=self.device)
+            elif self.backend in ("onnx", "onnx-fp32"):
+                from bertalign.backends import OnnxBackend
+                self._model = OnnxBackend(self.model_name, quantize=self.backend == "onnx")
+            else:
+                raise Exception('Unknown encoder backend {}'.format(self.backend))
+        return self._model
+
+    @property
+    def dim(self):
+        """Embedding dimension of the model."""
+        if self._dim is None:
+            get_dim = getattr(self.model, "get_sentence_embedding_dimension", None)
+            self._dim = get_dim() if get_dim is not None else None
+            if not self._dim: # 后端不报告维度就编码一个空串看看
+                self._dim = self.model.encode([""], batch_size=1).shape[1]
+        return self._dim
+
+    def start_pool(self, num_workers=None, threads_per_worker=1, chunk_size=64):
+        """
+        Encode with a pool of worker processes sharing this model.
+        Call it before encoding anything, and run Bertalign instances from
+        threads instead of processes so that their requests are batched together.
+        Also call it before any alignment with dp_threads > 1: the TBB
+        threading layer of numba does not survive fork.
+        """
+        from bertalign.pool import EncoderPool
+        self.pool = EncoderPool(self.model, num_workers, threads_per_worker, chunk_size)
+
+    def stop_pool(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def transform(self, sents, num_overlaps, first_overlap=1):
+        """
+        Embed all overlap windows of sents.
+        Args:
+            sents: list of str.
+            num_overlaps: int. Largest number of sentences in a window.
+            first_overlap: int. Smallest number of sentences in a window,
+                           layers below it are not encoded.
+        Returns:
+            sent_vecs: numpy array of shape (num_layers, len(sents), embedding_dim).
+            len_vecs: numpy array of shape (num_layers, len(sents)).
+        """
+        return self.transform_many([sents], num_overlaps, first_overlap)[0]
+
+    def transform_many(self, docs, num_overlaps, first_overlap=1, chunk_size=ENCODE_CHUNK):
+        """
+        Same as transform for several documents at once. The distinct strings
+        of all documents are encoded together, so encoder batches are not
+        limited by the size of one document.
+        Args:
+            docs: list of list of str.
+            chunk_size: int. Number of distinct strings sent to the encoder
+                        at a time, bounds the overlap strings held in memory.
+        Returns:
+            list of (sent_vecs, len_vecs), one per document.
+        """
+        # Overlap strings are consumed as a stream and encoded chunk by chunk,
+        # each distinct string of a chunk once, and the vectors are scattered
+        # into the output arrays as soon as the chunk is done.
+        # The first (overlap - 1) rows of each layer are PAD and never read
+        # by the DP, so they keep a constant zero vector instead.
+        num_layers = num_overlaps - first_overlap + 1
+        out = [None] * len(docs)
+        unique_ids = {}
+        places = [] # (doc, pos, unique id) of every string of the chunk
+
+        def flush():
+            unique_vecs = self.encode(list(unique_ids))
+            for doc, sents in enumerate(docs):
+                if out[doc] is None:
+                    out[doc] = np.zeros((num_layers * len(sents), unique_vecs.shape[1]), dtype=unique_vecs.dtype)
+            if places:
+                doc_idx, pos_idx, ids = np.array(places).T
+                for doc in np.unique(doc_idx):
+                    mask = doc_idx == doc
+                    out[doc][pos_idx[mask]] = unique_vecs[ids[mask]]
+            unique_ids.clear()
+            places.clear()
+
+        for doc, sents in enumerate(docs):
+            num_sents = len(sents)
+            for pos, line in enumerate(yield_overlaps(sents, num_overlaps, first_overlap)):
+                if pos % num_sents < pos // num_sents + first_overlap - 1:
+                    continue
+                if line not in unique_ids and len(unique_ids) >= chunk_size:
+                    flush()
+                places.append((doc, pos, unique_ids.setdefault(line, len(unique_ids))))
+        if unique_ids or any(sent_vecs is None for sent_vecs in out):
+            flush()
+
+        results = []
+        for sents, sent_vecs in zip(docs, out):
+            sent_vecs = sent_vecs.reshape(num_layers, len(sents), sent_vecs.shape[1])
+            len_vecs = overlap_lengths(sents, num_overlaps, first_overlap)
+            results.append((sent_vecs, len_vecs))
+        return results
 
-    def transform(self, sents, num_overlaps):
-        overlaps = []
-        for line in yield_overlaps(sents, num_overlaps):
-            overlaps.append(line)
+    def encode(self, lines):
+        """
+        Encode lines, looking them up in the embedding store first if there is one.
+        """
+        if self.store is None or len(lines) == 0:
+            return self.encode_batched(lines)
+        vecs, missing = self.store.lookup(lines)
+        if missing:
+            new_vecs = self.encode_batched([lines[i] for i in missing])
+            self.store.add([lines[i] for i in missing], new_vecs)
+            if vecs is None:
+                vecs = np.empty((len(lines), new_vecs.shape[1]), dtype=np.float32)
+            vecs[missing] = new_vecs
+        return vecs
 
-        sent_vecs = self.model.encode(overlaps)
-        embedding_dim = sent_vecs.size // (len(sents) * num_overlaps)
-        sent_vecs.resize(num_overlaps, len(sents), embedding_dim)
+    def encode_batched(self, lines):
+        """
+        Encode lines sorted by token length, so each batch holds sentences of
+        similar length and little padding. The batch size of each length
+        bucket is chosen to fit the token budget. Vectors are returned in the
+        original order.
+        """
+        if len(lines) == 0:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        lines, lengths = self.truncate(lines)
+        if self.pool is not None: # 进程池自己按长度排序分块
+            return self.pool.encode(lines)
+        order = np.argsort(lengths, kind="stable")
+        vecs = None
+        start = 0
+        while start < len(order):
+            end = start + 1
+            while end < len(order) and end - start < self.max_batch_size \
+                    and (end - start + 1) * lengths[order[end]] <= self.max_tokens:
+                end += 1
+            batch = order[start:end]
+            batch_vecs = self.model.encode([lines[i] for i in batch], batch_size=len(batch))
+            if vecs is None:
+                vecs = np.empty((len(lines), batch_vecs.shape[1]), dtype=batch_vecs.dtype)
+                self._dim = batch_vecs.shape[1]
+            vecs[batch] = batch_vecs
+            start = end
+        return vecs
 
-        len_vecs = [len(line.encode("utf-8")) for line in overlaps]
-        len_vecs = np.array(len_vecs)
-        len_vecs.resize(num_overlaps, len(sents))
+    def truncate(self, lines):
+        """
+        Cut lines at the max sequence length of the model in tokens, so the
+        tokenizer of the model does not have to tokenize text that is dropped anyway.
+        Returns:
+            lines: list of str. Truncated lines.
+            lengths: numpy array. Number of tokens of each line.
+        """
+        tokenizer = self.model.tokenizer
+        if not getattr(tokenizer, "is_fast", False): # 没有offset mapping就按字符数估长度
+            return lines, np.array([len(line) for line in lines])
 
-        return sent_vecs, len_vecs
+        max_len = self.model.get_max_seq_length() - 2 # [CLS] and [SEP]
+        encoded = tokenizer(lines, add_special_tokens=False, truncation=True,
+                            max_length=max_len, return_offsets_mapping=True)
+        truncated = []
+        lengths = []
+        for line, offsets in zip(lines, encoded["offset_mapping"]):
+            if len(offsets) >= max_len:
+                line = line[:offsets[-1][1]]
+            truncated.append(line)
+            lengths.append(len(offsets) + 2)
+        return truncated, np.array(lengths)
@@ -0,0 +1,214 @@
+import sys
+import time
+import queue
+import itertools
+import threading
+import multiprocessing as mp
+import numpy as np
+
+from concurrent.futures import Future
+
+# 收集线程多久检查一次worker进程是否还活着，单位秒
+WORKER_POLL = 1.0
+
+class EncoderPool:
+    """
+    Pool of model worker processes behind one request queue.
+    Requests from all Bertalign instances (threads) of the process are merged,
+    sorted by length and cut into chunks that go to the least loaded worker.
+    Workers are forked from the process that already holds the model,
+    so the weights are shared copy-on-write instead of loaded N times.
+    If a worker process dies, the requests it had in flight fail and
+    the remaining workers keep going.
+    """
+    def __init__(self, model, num_workers=None, threads_per_worker=1, chunk_size=64):
+        """
+        Args:
+            model: SentenceTransformer. Loaded model, shared with the workers.
+            num_workers: int. Number of worker processes, cpu count // threads_per_worker by default.
+            threads_per_worker: int. Intra-op threads of each worker, for torch models
+                                and backends with a set_num_threads() method.
+            chunk_size: int. Number of lines a worker encodes at a time.
+        """
+        if num_workers is None:
+            num_workers = max(1, mp.cpu_count() // threads_per_worker)
+        self.chunk_size = chunk_size
+        self._requests = queue.Queue()
+        self._chunks = {}
+        self._chunk_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._in_flight = threading.Semaphore(2 * num_workers)
+        self._load = [0] * num_workers # chunks in flight of each worker
+        self._dead = set()
+        self._closing = False
+
+        # fork要在起线程之前，且父进程最好还没跑过推理，否则OpenMP线程池在子进程里可能卡死
+        ctx = mp.get_context("fork")
+        # 每个worker一个任务队列，这样知道哪个chunk在哪个worker手里
+        self._tasks = [ctx.Queue() for _ in range(num_workers)]
+        self._results = ctx.Queue()
+        self._workers = [ctx.Process(target=_worker,
+                                     args=(model, threads_per_worker, tasks, self._results),
+                                     daemon=True)
+                         for tasks in self._tasks]
+        for worker in self._workers:
+            worker.start()
+
+        self._threads = [threading.Thread(target=self._dispatch, daemon=True),
+                         threading.Thread(target=self._collect, daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, lines):
+        """
+        Queue lines for encoding.
+        Returns:
+            future: Future of a numpy array of shape (len(lines), embedding_dim).
+        """
+        future = Future()
+        if len(lines) == 0:
+            future.set_result(np.zeros((0, 0), dtype=np.float32))
+        else:
+            self._requests.put((list(lines), future))
+        return future
+
+    def encode(self, lines, **kwargs):
+        """
+        Same as SentenceTransformer.encode, blocking until lines are encoded.
+        """
+        return self.submit(lines).result()
+
+    def close(self):
+        self._closing = True
+        self._requests.put(None)
+        for tasks in self._tasks:
+            tasks.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._results.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _dispatch(self):
+        while True:
+            pending = [self._requests.get()]
+            # 把排队中的请求一起拿出来合批
+            while True:
+                try:
+                    pending.append(self._requests.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in pending
+
+            items = []
+            for request in pending:
+                if request is None:
+                    continue
+                lines, future = request
+                state = [None, len(lines), future] # vecs, lines left, future
+                items.extend((line, idx, state) for idx, line in enumerate(lines))
+            items.sort(key=lambda item: len(item[0]))
+
+            for start in range(0, len(items), self.chunk_size):
+                chunk = items[start:start + self.chunk_size]
+                chunk_id = next(self._chunk_ids)
+                # Keep only a few chunks in flight so that new requests
+                # queue up here and get merged into the next round.
+                self._in_flight.acquire()
+                targets = [(idx, state) for _, idx, state in chunk]
+                with self._lock:
+                    alive = [worker for worker in range(len(self._workers)) if worker not in self._dead]
+                    if alive:
+                        worker = min(alive, key=self._load.__getitem__)
+                        self._load[worker] += 1
+                        self._chunks[chunk_id] = (worker, targets)
+                if not alive:
+                    self._in_flight.release()
+                    _fail(targets, RuntimeError("all encoder workers have exited"))
+                    continue
+                self._tasks[worker].put((chunk_id, [line for line, _, _ in chunk]))
+            if stop:
+                return
+
+    def _collect(self):
+        last_check = time.monotonic()
+        while True:
+            if time.monotonic() - last_check >= WORKER_POLL:
+                self._check_workers()
+                last_check = time.monotonic()
+            try:
+                result = self._results.get(timeout=WORKER_POLL)
+            except queue.Empty:
+                continue
+            if result is None:
+                return
+            chunk_id, vecs = result
+            with self._lock:
+                if chunk_id not in self._chunks: # worker已被判定退出，chunk已经失败
+                    continue
+                worker, targets = self._chunks.pop(chunk_id)
+                self._load[worker] -= 1
+            self._in_flight.release()
+            if isinstance(vecs, Exception):
+                _fail(targets, vecs)
+                continue
+            for row, (idx, state) in enumerate(targets):
+                future = state[2]
+                if future.done():
+                    continue
+                if state[0] is None:
+                    state[0] = np.empty((state[1], vecs.shape[1]), dtype=vecs.dtype)
+                state[0][idx] = vecs[row]
+                state[1] -= 1
+                if state[1] == 0:
+                    future.set_result(state[0])
+
+    def _check_workers(self):
+        """
+        Fail the chunks in flight of worker processes that have exited,
+        their results will never come.
+        """
+        if self._closing:
+            return
+        for worker, proc in enumerate(self._workers):
+            if worker in self._dead or proc.exitcode is None:
+                continue
+            with self._lock:
+                self._dead.add(worker)
+                lost = [chunk_id for chunk_id, (owner, _) in self._chunks.items() if owner == worker]
+                lost = [self._chunks.pop(chunk_id)[1] for chunk_id in lost]
+                self._load[worker] = 0
+            error = RuntimeError("encoder worker {} exited with code {}".format(proc.pid, proc.exitcode))
+            for targets in lost:
+                self._in_flight.release()
+                _fail(targets, error)
+
+def _fail(targets, error):
+    for _, state in targets:
+        if not state[2].done():
+            state[2].set_exception(error)
+
+def _set_num_threads(model, num_threads):
+    """
+    Backends with a set_num_threads() method like OnnxBackend set their own
+    threads, torch models the torch intra-op threads, other backends are left as is.
+    """
+    if hasattr(model, "set_num_threads"):
+        model.set_num_threads(num_threads)
+        return
+    torch = sys.modules.get("torch") # torch模型的话父进程已经导入过torch
+    if torch is not None and isinstance(model, torch.nn.Module):
+        torch.set_num_threads(num_threads)
+
+def _worker(model, num_threads, tasks, results):
+    _set_num_threads(model, num_threads)
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        chunk_id, lines = task
+        try:
+            vecs = model.encode(lines, batch_size=len(lines))
+        except Exception as e:
+            vecs = e
+        results.put((chunk_id, vecs))
@@ -0,0 +1,63 @@
+import numpy as np
+
+class Projection:
+    """
+    Linear map of the embeddings to fewer dimensions, applied after
+    Encoder.transform so that the DP runs on shorter vectors.
+    Projected vectors are renormalized, so dot products stay cosine similarities.
+    """
+    def __init__(self, matrix):
+        """
+        Args:
+            matrix: numpy array of shape (embedding_dim, dim).
+        """
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+
+    @property
+    def dim(self):
+        return self.matrix.shape[1]
+
+    @classmethod
+    def fit_pca(cls, vecs, dim, max_samples=100000, seed=0):
+        """
+        Fit the top dim principal directions of vecs.
+        The vecs are not centered, so the projection keeps the dot products
+        between them as well as a rank-dim map can.
+        Args:
+            vecs: numpy array of shape (..., embedding_dim), e.g. layer 0 of
+                  Encoder.transform for a sample of the corpus.
+            dim: int. Output dimension.
+            max_samples: int. Number of vectors to fit on at most.
+        """
+        vecs = np.asarray(vecs, dtype=np.float32).reshape(-1, np.shape(vecs)[-1])
+        vecs = vecs[np.abs(vecs).sum(axis=1) > 0] # drop PAD rows
+        if len(vecs) > max_samples:
+            vecs = vecs[np.random.default_rng(seed).choice(len(vecs), max_samples, replace=False)]
+        _, _, vt = np.linalg.svd(vecs, full_matrices=False)
+        return cls(vt[:dim].T)
+
+    @classmethod
+    def truncate(cls, embedding_dim, dim):
+        """
+        Keep the first dim coordinates, for Matryoshka-style models
+        trained so that the prefix of the embedding is an embedding itself.
+        """
+        return cls(np.eye(embedding_dim, dim, dtype=np.float32))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f["matrix"])
+
+    def save(self, path):
+        np.savez(path, matrix=self.matrix)
+
+    def transform(self, vecs):
+        """
+        Project vecs of shape (..., embedding_dim) to (..., dim).
+        """
+        out = np.asarray(vecs, dtype=np.float32) @ self.matrix
+        norms = np.linalg.norm(out, axis=-1, keepdims=True)
+        norms[norms == 0] = 1
+        out /= norms
+        return out
@@ -0,0 +1,200 @@
+import re
+import abc
+import json
+import itertools
+import numpy as np
+
+from xml.sax.saxutils import escape, quoteattr
+
+class BeadArray:
+    """
+    Alignment of one language pair as bead boundaries.
+    Bead k covers the source sentences [src_start[k], src_end[k]) and the
+    target sentences [tgt_start[k], tgt_end[k]), either side may be empty.
+    Iterating gives the beads as ([src ids], [tgt ids]) like second_back_track.
+    score, similarity and margin are set by Bertalign, see corelib.score_beads,
+    so bad beads can be filtered without encoding them again:
+        good = beads.score > 0.5
+    margin is the similarity minus the average similarity to the neighbours,
+    i.e. the score before the length penalty.
+    """
+    def __init__(self, src_start, src_end, tgt_start, tgt_end, score=None, similarity=None, margin=None):
+        self.src_start = np.asarray(src_start, dtype=np.int32)
+        self.src_end = np.asarray(src_end, dtype=np.int32)
+        self.tgt_start = np.asarray(tgt_start, dtype=np.int32)
+        self.tgt_end = np.asarray(tgt_end, dtype=np.int32)
+        self.score = score
+        self.similarity = similarity
+        self.margin = margin
+
+    @property
+    def types(self):
+        """Alignment type (source sentences, target sentences) of each bead."""
+        return np.stack([self.src_end - self.src_start, self.tgt_end - self.tgt_start], axis=1)
+
+    @classmethod
+    def from_beads(cls, beads):
+        """
+        Args:
+            beads: list of (src ids, tgt ids), consecutive ids in each bead.
+        """
+        bounds = np.zeros((4, len(beads)), dtype=np.int32)
+        src_pos, tgt_pos = 0, 0
+        for k, (src_bead, tgt_bead) in enumerate(beads):
+            if len(src_bead) > 0:
+                src_pos = src_bead[0]
+            if len(tgt_bead) > 0:
+                tgt_pos = tgt_bead[0]
+            bounds[:, k] = src_pos, src_pos + len(src_bead), tgt_pos, tgt_pos + len(tgt_bead)
+            src_pos += len(src_bead)
+            tgt_pos += len(tgt_bead)
+        return cls(*bounds)
+
+    def __len__(self):
+        return len(self.src_start)
+
+    def __getitem__(self, k):
+        return (list(range(self.src_start[k], self.src_end[k])),
+                list(range(self.tgt_start[k], self.tgt_end[k])))
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+    def __eq__(self, other):
+        if not isinstance(other, BeadArray):
+            return NotImplemented
+        return all(np.array_equal(getattr(self, name), getattr(other, name))
+                   for name in ("src_start", "src_end", "tgt_start", "tgt_end"))
+
+    def texts(self, src_lines, tgt_lines):
+        """
+        Yields:
+            (src_text, tgt_text) of each bead, the sentences joined by spaces.
+        """
+        for src_start, src_end, tgt_start, tgt_end in zip(self.src_start.tolist(), self.src_end.tolist(),
+                                                          self.tgt_start.tolist(), self.tgt_end.tolist()):
+            yield ' '.join(src_lines[src_start:src_end]), ' '.join(tgt_lines[tgt_start:tgt_end])
+
+def iter_pairs(aligner):
+    """
+    Yields:
+        (lang, beads, src_lines, tgt_lines) of each language aligned to the pivot.
+    """
+    tgt_lines = aligner.sents[aligner.pivot]["text_lines"]
+    for lang, beads in aligner.result.items():
+        yield lang, beads, aligner.sents[lang]["text_lines"], tgt_lines
+
+class ResultWriter(abc.ABC):
+    """
+    Writes the aligned beads of Bertalign objects one record at a time,
+    the text of a bead is only built when it is written.
+        with JsonlWriter("aligned.jsonl") as writer:
+            for aligner in Bertalign.align_many(rows):
+                writer.write(aligner)
+    """
+    def __init__(self, path):
+        self.path = path
+
+    @abc.abstractmethod
+    def write(self, aligner):
+        """Write the beads of every language pair of aligner."""
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class JsonlWriter(ResultWriter):
+    """One json object per bead: record, src_lang, tgt_lang, src, tgt, and score if the beads have one."""
+    def __init__(self, path, mode="w"):
+        super().__init__(path)
+        self.file = open(path, mode, encoding="utf-8")
+
+    def write(self, aligner):
+        for lang, beads, src_lines, tgt_lines in iter_pairs(aligner):
+            scores = itertools.repeat(None) if beads.score is None else beads.score.tolist()
+            for (src_text, tgt_text), score in zip(beads.texts(src_lines, tgt_lines), scores):
+                item = {"record": aligner.record, "src_lang": lang, "tgt_lang": aligner.pivot,
+                        "src": src_text, "tgt": tgt_text}
+                if score is not None:
+                    item["score"] = score
+                json.dump(item, self.file, ensure_ascii=False)
+                self.file.write("\n")
+
+    def close(self):
+        self.file.close()
+
+class ParquetWriter(ResultWriter):
+    """
+    One row per bead with the bead boundaries and texts, every language pair
+    of a record is written as one row group. Needs pyarrow.
+    """
+    def __init__(self, path, compression="zstd"):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        super().__init__(path)
+        self._pa = pa
+        self.schema = pa.schema([("record", pa.string()), ("src_lang", pa.string()), ("tgt_lang", pa.string()),
+                                 ("src_start", pa.int32()), ("src_end", pa.int32()),
+                                 ("tgt_start", pa.int32()), ("tgt_end", pa.int32()), ("score", pa.float32()),
+                                 ("src", pa.large_string()), ("tgt", pa.large_string())])
+        self.writer = pq.ParquetWriter(path, self.schema, compression=compression)
+
+    def write(self, aligner):
+        pa = self._pa
+        for lang, beads, src_lines, tgt_lines in iter_pairs(aligner):
+            src_texts, tgt_texts = [], []
+            for src_text, tgt_text in beads.texts(src_lines, tgt_lines):
+                src_texts.append(src_text)
+                tgt_texts.append(tgt_text)
+            num_beads = len(beads)
+            table = pa.Table.from_arrays([pa.array([str(aligner.record)] * num_beads, pa.string()),
+                                          pa.array([lang] * num_beads, pa.string()),
+                                          pa.array([aligner.pivot] * num_beads, pa.string()),
+                                          pa.array(beads.src_start), pa.array(beads.src_end),
+                                          pa.array(beads.tgt_start), pa.array(beads.tgt_end),
+                                          pa.nulls(num_beads, pa.float32()) if beads.score is None
+                                          else pa.array(beads.score, pa.float32()),
+                                          pa.array(src_texts, pa.large_string()),
+                                          pa.array(tgt_texts, pa.large_string())], schema=self.schema)
+            self.writer.write_table(table)
+
+    def close(self):
+        self.writer.close()
+
+_XML_INVALID = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+class TmxWriter(ResultWriter):
+    """
+    TMX 1.4 translation memory, one <tu> per bead with sentences on both sides.
+    Insertions and deletions are skipped.
+    """
+    def __init__(self, path, srclang="en"):
+        super().__init__(path)
+        self.file = open(path, "w", encoding="utf-8")
+        self.file.write('<?xml version="1.0" encoding="UTF-8"?>\n<tmx version="1.4">\n'
+                        f'<header creationtool="bertalign" creationtoolversion="1" datatype="plaintext" '
+                        f'segtype="sentence" adminlang="en" srclang={quoteattr(srclang)} o-tmf="bertalign"/>\n'
+                        '<body>\n')
+
+    def write(self, aligner):
+        for lang, beads, src_lines, tgt_lines in iter_pairs(aligner):
+            for src_text, tgt_text in beads.texts(src_lines, tgt_lines):
+                if not src_text or not tgt_text:
+                    continue
+                self.file.write(f'<tu><prop type="record">{escape(str(aligner.record))}</prop>'
+                                f'<tuv xml:lang={quoteattr(aligner.pivot)}><seg>{_xml_text(tgt_text)}</seg></tuv>'
+                                f'<tuv xml:lang={quoteattr(lang)}><seg>{_xml_text(src_text)}</seg></tuv></tu>\n')
+
+    def close(self):
+        self.file.write('</body>\n</tmx>\n')
+        self.file.close()
+
+def _xml_text(text):
+    return escape(_XML_INVALID.sub('', text))
@@ -0,0 +1,283 @@
+"""
+Long-running local alignment server, keeps the encoder and the numba kernels warm.
+
+    python -m bertalign.server --port 8765 --langs de fr --pivot fr --is-splited
+    python -m bertalign.server --unix /tmp/bertalign.sock
+
+POST /align with a row as JSON body, e.g. {"record": "1", "de": "...", "fr": "..."}.
+Add "text": true to get the aligned texts besides the bead boundaries.
+GET /health returns the number of pending requests and counters.
+
+Requests arriving together are encoded in one Encoder call like
+Bertalign.align_many, and the DP runs on a thread pool. A malformed row only
+fails its own request with 400. When max_pending requests are queued or
+being aligned new ones get 503, a request not done within its timeout gets 504.
+"""
+import argparse
+import asyncio
+import json
+import time
+import numpy as np
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+class BadRequest(Exception):
+    pass
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error",
+           503: "Service Unavailable", 504: "Gateway Timeout"}
+
+class AlignServer:
+    def __init__(self, batch_records=16, max_wait=0.01, dp_workers=4, max_pending=256, timeout=60.0, **kwargs):
+        """
+        Args:
+            batch_records: int. Number of requests encoded together at most.
+            max_wait: float. Seconds the first request of a batch waits for others.
+            dp_workers: int. Number of records aligned concurrently.
+            max_pending: int. Number of requests in progress before answering 503.
+            timeout: float. Seconds before a request is answered with 504.
+            kwargs: passed to Bertalign.
+        """
+        self.batch_records = batch_records
+        self.max_wait = max_wait
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.kwargs = kwargs
+        self.stats = Counter()
+        # 编码只用一个线程，模型本身是并行的；DP的numba kernel不持有GIL
+        self._encode_executor = ThreadPoolExecutor(max_workers=1)
+        self._dp_executor = ThreadPoolExecutor(max_workers=dp_workers)
+        self._queue = None
+        self._tasks = set() # 正在对齐的任务，留着引用免得被回收
+        self._pending = 0 # 排队和正在对齐的请求，超时的请求在算完之前也算
+
+    def warm_up(self):
+        """Load the model and compile the DP kernels before the first request."""
+        from bertalign.aligner import Bertalign, lang_list
+        langs = self.kwargs.get("langs") or lang_list
+        row = {"record": "warm up", **{lang: "Bertalign warm up.\nSecond sentence." for lang in langs}}
+        for aligner in Bertalign.encode_many([row], **self.kwargs):
+            aligner.align_sents()
+
+    async def start(self, host="127.0.0.1", port=8765, path=None):
+        """Start listening on host:port, or on the Unix socket path if given."""
+        self._queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._encode_executor, self.warm_up)
+        self._batcher = asyncio.create_task(self._batch_loop())
+        if path is not None:
+            return await asyncio.start_unix_server(self._handle, path=path)
+        return await asyncio.start_server(self._handle, host, port)
+
+    async def align(self, row):
+        """
+        Queue row for alignment.
+        Returns:
+            (status, payload)
+        """
+        try:
+            self._check_row(row)
+        except BadRequest as e:
+            self.stats["bad_request"] += 1
+            return 400, {"error": str(e)}
+        if self._pending >= self.max_pending:
+            self.stats["rejected"] += 1
+            return 503, {"error": "too many pending requests"}
+        future = asyncio.get_running_loop().create_future()
+        self._pending += 1
+        self._queue.put_nowait((row, future))
+        try:
+            aligner = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self.stats["timeout"] += 1
+            return 504, {"error": "alignment timed out"}
+        except BadRequest as e:
+            self.stats["bad_request"] += 1
+            return 400, {"error": str(e)}
+        except Exception as e:
+            self.stats["failed"] += 1
+            return 500, {"error": repr(e)}
+        self.stats["aligned"] += 1
+        return 200, _result_json(aligner, row.get("text", False))
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.batch_records:
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+            for _, future in batch:
+                if future.done():
+                    self._finish(future)
+            batch = [(row, future) for row, future in batch if not future.done()]
+            if not batch:
+                continue
+            self.stats["batches"] += 1
+            try:
+                aligners = await loop.run_in_executor(self._encode_executor, self._encode_batch,
+                                                      [row for row, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    self._finish(future, exception=e)
+                continue
+            # 下一批的编码和这一批的DP同时进行
+            for aligner, (_, future) in zip(aligners, batch):
+                if isinstance(aligner, Exception):
+                    self._finish(future, exception=aligner)
+                    continue
+                task = asyncio.ensure_future(self._align_one(aligner, future))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    def _check_row(self, row):
+        from bertalign.aligner import lang_list
+        if not isinstance(row, dict):
+            raise BadRequest("row must be a JSON object")
+        if "record" not in row:
+            raise BadRequest('missing "record"')
+        langs = self.kwargs.get("langs") or lang_list
+        for lang in [self.kwargs.get("pivot", "en")] + list(langs):
+            if not isinstance(row.get(lang), str):
+                raise BadRequest(f"missing text of {lang!r}")
+
+    def _encode_batch(self, rows):
+        """
+        Returns:
+            list with the encoded Bertalign object of each row, or the
+            BadRequest it failed with. Only valid rows are encoded together.
+        """
+        from bertalign.aligner import Bertalign
+        aligners = []
+        for row in rows:
+            try:
+                aligners.append(Bertalign(row, encode=False, **self.kwargs))
+            except Exception as e:
+                aligners.append(BadRequest(repr(e)))
+        Bertalign.encode_together([aligner for aligner in aligners if not isinstance(aligner, Exception)])
+        return aligners
+
+    async def _align_one(self, aligner, future):
+        if future.done(): # 编码期间已经超时了，不用再算DP
+            self._finish(future)
+            return
+        try:
+            await asyncio.get_running_loop().run_in_executor(self._dp_executor, aligner.align_sents)
+        except Exception as e:
+            self._finish(future, exception=e)
+        else:
+            self._finish(future, result=aligner)
+
+    def _finish(self, future, result=None, exception=None):
+        self._pending -= 1
+        # 超时的请求已经被wait_for取消了
+        if future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                method, target, headers, body = request
+                if method == "POST" and target == "/align":
+                    try:
+                        row = json.loads(body)
+                    except ValueError as e:
+                        status, payload = 400, {"error": repr(e)}
+                    else:
+                        status, payload = await self.align(row)
+                elif method == "GET" and target == "/health":
+                    status, payload = 200, {"pending": self._pending, "queued": self._queue.qsize(), **self.stats}
+                else:
+                    status, payload = 404, {"error": "unknown path"}
+                keep_alive = headers.get("connection", "").lower() != "close"
+                await _write_response(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        self._batcher.cancel()
+        self._encode_executor.shutdown()
+        self._dp_executor.shutdown()
+
+def _result_json(aligner, with_text=False):
+    result = {}
+    tgt_lines = aligner.sents[aligner.pivot]["text_lines"]
+    for lang, beads in aligner.result.items():
+        bounds = np.stack([beads.src_start, beads.src_end, beads.tgt_start, beads.tgt_end], axis=1)
+        item = {"beads": bounds.tolist(), "score": beads.score.tolist()}
+        if with_text:
+            item["text"] = list(beads.texts(aligner.sents[lang]["text_lines"], tgt_lines))
+        result[lang] = item
+    return {"record": aligner.record, "pivot": aligner.pivot, "result": result}
+
+async def _read_request(reader):
+    line = await reader.readline()
+    if not line:
+        return None
+    method, target, _ = line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, value = line.decode("latin-1").split(":", 1)
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return method, target, headers, body
+
+async def _write_response(writer, status, payload, keep_alive=True):
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                 f"Content-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\n"
+                 f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + body)
+    await writer.drain()
+
+async def serve(args):
+    server = AlignServer(batch_records=args.batch_records, max_wait=args.max_wait, dp_workers=args.dp_workers,
+                         max_pending=args.max_pending, timeout=args.timeout,
+                         max_align=args.max_align, is_splited=args.is_splited, langs=args.langs, pivot=args.pivot,
+                         vec_dtype=args.vec_dtype, log_func=lambda info: None)
+    t = time.perf_counter()
+    listener = await server.start(args.host, args.port, args.unix)
+    print(f"warm in {time.perf_counter() - t:.1f} s, listening on {args.unix or f'{args.host}:{args.port}'}")
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        server.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix", help="listen on this Unix socket instead of host:port")
+    parser.add_argument("--batch-records", type=int, default=16)
+    parser.add_argument("--max-wait", type=float, default=0.01)
+    parser.add_argument("--dp-workers", type=int, default=4)
+    parser.add_argument("--max-pending", type=int, default=256)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--max-align", type=int, default=5)
+    parser.add_argument("--langs", nargs="+")
+    parser.add_argument("--pivot", default="en")
+    parser.add_argument("--is-splited", action="store_true", help="rows are already one sentence per line")
+    parser.add_argument("--vec-dtype", default="float32")
+    asyncio.run(serve(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
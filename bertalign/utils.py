@@ -1,8 +1,6 @@
 import re
-from sentence_splitter import SentenceSplitter
-
-import process_en_text
-import process_zh_text
+import difflib
+import numpy as np
 
 
 def clean_text(text: str) -> str:
@@ -35,6 +33,7 @@ def auto_split_sents(text, lang):
         if lang == 'zh':
             sents = _split_zh(text)
         else:
+            from sentence_splitter import SentenceSplitter
             splitter = SentenceSplitter(language=lang)
             sents = splitter.split(text=text) 
             sents = [sent.strip() for sent in sents]
@@ -45,8 +44,10 @@ def auto_split_sents(text, lang):
 def split_sents(text, lang):
     if lang in LANG.SPLITTER:
         if lang == 'zh':
+            import process_zh_text
             sents = process_zh_text.start(text).split("\n")
         else:
+            import process_en_text
             sents = process_en_text.start(text).split("\n")
         return sents
     else:
@@ -72,14 +73,46 @@ def _split_zh(text, limit=1000):
 
         return sent_list
         
-def yield_overlaps(lines: list[str], num_overlaps: int) -> str:
+def yield_overlaps(lines: list[str], num_overlaps: int, first_overlap: int = 1) -> str:
     lines = [_preprocess_line(line) for line in lines]
-    for overlap in range(1, num_overlaps + 1):
+    for overlap in range(first_overlap, num_overlaps + 1):
         for out_line in _layer(lines, overlap): # 输出num_overlaps * len(lines) 个句子
             # check must be here so all outputs are unique
             out_line2 = out_line[:10000]  # limit line so dont encode arbitrarily long sentences
             yield out_line2
 
+def overlap_lengths(lines: list[str], num_overlaps: int, first_overlap: int = 1) -> np.ndarray:
+    """yield_overlaps输出的每个句子的UTF-8字节数，用单句长度的前缀和算，不拼字符串
+    PAD位置的长度和'PAD'一样是3，窗口长度不受10000字符截断影响
+    Returns:
+        numpy array of shape (num_overlaps - first_overlap + 1, len(lines)).
+    """
+    sent_lens = np.array([len(_preprocess_line(line).encode("utf-8")) for line in lines], dtype=np.int64)
+    cum_lens = np.concatenate([[0], np.cumsum(sent_lens)])
+    num_lines = len(lines)
+    lens = np.full((num_overlaps - first_overlap + 1, num_lines), len('PAD'), dtype=np.int64)
+    for layer, overlap in enumerate(range(first_overlap, num_overlaps + 1)):
+        if overlap > num_lines:
+            continue
+        # window [i - overlap + 1, i] joined by overlap - 1 spaces
+        lens[layer, overlap - 1:] = cum_lens[overlap:] - cum_lens[:num_lines - overlap + 1] + overlap - 1
+    return lens
+
+def overlap_line(lines: list[str], end: int, overlap: int) -> str:
+    """yield_overlaps第overlap层里以lines[end]结尾的句子，end >= overlap - 1"""
+    return ' '.join(_preprocess_line(line) for line in lines[end - overlap + 1:end + 1])[:10000]
+
+def diff_lines(old_lines: list[str], new_lines: list[str]) -> np.ndarray:
+    """new_lines每一行在old_lines里对应的下标，新增或改过的行是-1
+    Returns:
+        numpy array of shape (len(new_lines),), increasing where it is not -1.
+    """
+    index = np.full(len(new_lines), -1, dtype=np.int64)
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for block in matcher.get_matching_blocks():
+        index[block.b:block.b + block.size] = np.arange(block.a, block.a + block.size)
+    return index
+
 def _layer(lines: list[str], num_overlaps: int, comb=' ') -> list[str]:
     """把临近num_overlaps合到一起，PAD到输出的out和lines等长
     例：
@@ -6,7 +6,7 @@ from datasets import load_dataset
 from bertalign import Bertalign
 import process_zh_text
 import process_en_text
-from helper import dump_align_result_to_file
+from helper import dump_aligner_to_file
 
 
 
@@ -21,8 +21,7 @@ def cat(*args): return '/'.join(args)
 def without_preprocess(row):
     aligner = Bertalign(row)
     aligner.align_sents()
-    result = aligner.create_result()
-    dump_align_result_to_file(row['record'], result)
+    dump_aligner_to_file(aligner)
 
 
  # dst = 'en'
@@ -62,6 +62,16 @@ def dump_align_result_to_file(record: str, result: dict):
         with open(my_path(ALIGNED_DIR, f"aligned_{lang}.txt"), "a", encoding="utf-8") as f:
             f.write(make_banner(record) + result[lang])
 
+def dump_aligner_to_file(aligner):
+    """和dump_align_result_to_file输出一样，但逐个bead写，不拼整篇的字符串"""
+    Path(my_path(ALIGNED_DIR)).mkdir(parents=True, exist_ok=True)
+    tgt_lines = aligner.sents[aligner.pivot]["text_lines"]
+    for lang, beads in aligner.result.items():
+        with open(my_path(ALIGNED_DIR, f"aligned_{lang}.txt"), "a", encoding="utf-8") as f:
+            f.write(make_banner(aligner.record))
+            for src_line, tgt_line in beads.texts(aligner.sents[lang]["text_lines"], tgt_lines):
+                f.write(src_line + "\n" + tgt_line + "\n \n")
+
 
 
 
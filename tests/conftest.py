@@ -0,0 +1,35 @@
+import os
+# TBB不能fork：并行kernel跑过之后再起EncoderPool，退出时会卡在TBB的清理里
+os.environ.setdefault("NUMBA_THREADING_LAYER", "workqueue")
+
+import zlib
+import numpy as np
+import pytest
+
+import bertalign
+from bertalign.encoder import Encoder
+
+class FakeModel:
+    """每个词一个固定的随机向量，句向量是词向量的和，不用下载模型"""
+    tokenizer = None
+
+    def __init__(self, dim=32):
+        self.dim = dim
+        self.calls = []
+
+    def get_max_seq_length(self):
+        return 256
+
+    def encode(self, lines, batch_size=32, **kwargs):
+        self.calls.append(list(lines))
+        vecs = np.zeros((len(lines), self.dim), dtype=np.float32)
+        for vec, line in zip(vecs, lines):
+            for word in line.split():
+                vec += np.random.default_rng(zlib.crc32(word.strip(".").lower().encode())).normal(size=self.dim)
+        return vecs / np.maximum(np.linalg.norm(vecs, axis=1, keepdims=True), 1e-9)
+
+@pytest.fixture
+def fake_model(monkeypatch):
+    model = FakeModel()
+    monkeypatch.setattr(bertalign, "model", Encoder("fake", backend=model))
+    return model
@@ -0,0 +1,126 @@
+import pytest
+
+from bertalign import Bertalign
+from bertalign.aligner import align_stats
+from bertalign.corelib import find_top_k_sents
+
+def doc(num_sents, first=0):
+    return "\n".join("w{0} v{0} u{0}.".format(i) for i in range(first, first + num_sents))
+
+def aligner(row, **kwargs):
+    return Bertalign(row, is_splited=True, langs=["de"], pivot="fr", log_func=lambda info: None, **kwargs)
+
+@pytest.mark.parametrize("margin", ["KNN", "neighbor", None])
+def test_unknown_margin(fake_model, margin):
+    with pytest.raises(Exception, match="Unknown margin"):
+        aligner({"record": "1", "de": doc(3), "fr": doc(3)}, margin=margin)
+
+def one_to_one(beads, offset=0):
+    return sum(1 for src, tgt in beads if len(src) == 1 and tgt == [src[0] + offset])
+
+@pytest.mark.parametrize("chunk_size", [8, 20, 50])
+def test_chunked_follows_offset(fake_model, chunk_size):
+    # 目标端开头多出40句，按比例找的窗口够不到
+    row = {"record": "1", "de": doc(150, 40), "fr": doc(190)}
+    full = aligner(row)
+    full.align_sents()
+    chunked = aligner(row, chunk_size=chunk_size)
+    src_len = 150
+    D, I = find_top_k_sents(chunked._layer0("de"), chunked._layer0("fr"), k=chunked.top_k)
+    segments = chunked._chunked_first_pass(src_len, 190, D, I)
+    assert len(segments) >= src_len // chunk_size // 2
+    chunked.align_sents()
+    assert one_to_one(full.result["de"], 40) == src_len
+    assert list(chunked.result["de"]) == list(full.result["de"])
+
+def test_chunk_size_too_small(fake_model):
+    with pytest.raises(ValueError):
+        aligner({"record": "1", "de": doc(3), "fr": doc(3)}, chunk_size=4)
+
+def shifted_row(num_sents, start, span, shift):
+    """等长的两篇，[start, start + span)里目标端错开shift句，末尾补上新句子"""
+    src = ["w{0} v{0} u{0}.".format(i) for i in range(num_sents)]
+    tgt = list(src)
+    tgt[start:start + span - shift] = src[start + shift:start + span]
+    tgt[start + span - shift:start + span] = ["x{0} y{0} z{0}.".format(i) for i in range(shift)]
+    return {"record": "1", "de": "\n".join(src), "fr": "\n".join(tgt)}
+
+def test_fast_path_on_near_diagonal(fake_model):
+    row = shifted_row(100, 40, 1, 1)
+    fast = aligner(row)
+    fast.align_sents()
+    full = aligner(row, fast_path=False)
+    full.align_sents()
+    assert align_stats["fast_path"] > 0
+    assert list(fast.result["de"]) == list(full.result["de"])
+
+def test_fast_path_rejects_local_shift(fake_model):
+    # 只有很少句子输给邻居，但错开的6句远超FAST_PATH_WIN的band
+    row = shifted_row(400, 150, 18, 6)
+    fast = aligner(row)
+    fast.align_sents()
+    full = aligner(row, fast_path=False)
+    full.align_sents()
+    assert align_stats["fast_path"] == 0
+    assert list(fast.result["de"]) == list(full.result["de"])
+
+def test_pipeline_matches_blocking_encode(fake_model):
+    row = shifted_row(60, 20, 8, 2)
+    blocking = aligner(row)
+    blocking.align_sents()
+    pipelined = aligner(row, pipeline=True)
+    pipelined.align_sents()
+    assert list(pipelined.result["de"]) == list(blocking.result["de"])
+    for lang in ["de", "fr"]:
+        for key in ["vecs", "lens"]:
+            assert (pipelined.sents[lang][key] == blocking.sents[lang][key]).all()
+
+@pytest.mark.parametrize("margin", [True, False, "knn"])
+def test_previous_realigns_only_edits(fake_model, margin):
+    row = shifted_row(60, 20, 8, 2)
+    old = aligner(row, margin=margin)
+    old.align_sents()
+    lines = row["de"].split("\n")
+    lines[40] = "q1 q2 q3."
+    lines.insert(50, "q4 q5 q6.")
+    edited = dict(row, de="\n".join(lines))
+
+    num_calls = len(fake_model.calls)
+    incremental = aligner(edited, previous=old, margin=margin)
+    encoded = [line for call in fake_model.calls[num_calls:] for line in call]
+    # 只有包含改动句子的窗口：每处最多1 + 2 + 3 + 4个
+    assert 0 < len(encoded) <= 2 * 10
+    assert all("q1" in line or "q4" in line for line in encoded)
+    incremental.align_sents()
+    full = aligner(edited, margin=margin)
+    full.align_sents()
+    assert list(incremental.result["de"]) == list(full.result["de"])
+
+def split_at_periods(text, lang):
+    return [sent.strip() + "." for sent in text.split(".") if sent.strip()]
+
+def test_paragraphs_match_flat(fake_model, monkeypatch):
+    monkeypatch.setattr("bertalign.aligner.auto_split_sents", split_at_periods)
+    paras = [["w{0} v{0} u{0}".format(10 * p + i) for i in range(1 + p % 4)] for p in range(30)]
+    tgt = [list(para) for para in paras]
+    tgt[5] = tgt[5] + tgt[6] # 两段合成一段
+    del tgt[6]
+    del tgt[12]
+    tgt[20].insert(1, "x1 y1 z1")
+    render = lambda paras: "\n".join(". ".join(para) + "." for para in paras)
+    row = {"record": "1", "de": render(paras), "fr": render(tgt)}
+    flat = aligner(row, split_to_sents=True)
+    flat.align_sents()
+    grouped = aligner(row, split_to_sents=True, paragraphs=True)
+    grouped.align_sents()
+    assert len(grouped.sents["de"]["para_bounds"]) == len(paras) + 1
+    assert any(not tgt_bead for _, tgt_bead in flat.result["de"])
+    assert list(grouped.result["de"]) == list(flat.result["de"])
+
+def test_paragraphs_need_split_to_sents(fake_model):
+    with pytest.raises(ValueError):
+        aligner({"record": "1", "de": doc(3), "fr": doc(3)}, paragraphs=True)
+
+@pytest.fixture(autouse=True)
+def clear_align_stats():
+    align_stats.clear()
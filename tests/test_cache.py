@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+from bertalign.cache import EmbeddingStore, SQL_BATCH
+
+def vecs_of(texts, dim=8):
+    return np.array([np.random.default_rng(sum(map(ord, text))).normal(size=dim) for text in texts], dtype=np.float32)
+
+def test_round_trip(tmp_path):
+    texts = ["first sentence.", "second  sentence.", "third sentence."]
+    store = EmbeddingStore(tmp_path, "fake/model")
+    store.add(texts, vecs_of(texts))
+    vecs, missing = store.lookup(["third sentence.", "unknown", " second sentence. "])
+    assert missing == [1]
+    np.testing.assert_array_equal(vecs[[0, 2]], vecs_of(["third sentence.", "second  sentence."]))
+    store.close()
+
+    # 重新打开时从磁盘读，不经过LRU
+    store = EmbeddingStore(tmp_path, "fake/model", lru_size=0)
+    vecs, missing = store.lookup(texts)
+    assert missing == []
+    np.testing.assert_array_equal(vecs, vecs_of(texts))
+    assert len(store) == 3
+    store.close()
+
+def test_empty_store(tmp_path):
+    store = EmbeddingStore(tmp_path, "fake/model")
+    vecs, missing = store.lookup(["a", "b"])
+    assert vecs is None
+    assert missing == [0, 1]
+
+def test_eviction(tmp_path):
+    store = EmbeddingStore(tmp_path, "fake/model", max_entries=3, lru_size=0)
+    for text in ["a", "b", "c"]:
+        store.add([text], vecs_of([text]))
+    store.lookup(["a"])
+    store.add(["d"], vecs_of(["d"]))
+    assert len(store) == 3
+    vecs, missing = store.lookup(["a", "b", "c", "d"])
+    assert missing == [1]
+    np.testing.assert_array_equal(vecs[[0, 2, 3]], vecs_of(["a", "c", "d"]))
+
+def test_lru_hit_refreshes_disk_clock(tmp_path):
+    store = EmbeddingStore(tmp_path, "fake/model", max_entries=3, lru_size=10)
+    for text in ["a", "b", "c"]:
+        store.add([text], vecs_of([text]))
+    # "a" is served from the LRU, its disk entry must not be the oldest any more
+    store.lookup(["a"])
+    store.add(["d"], vecs_of(["d"]))
+    _, missing = store.lookup(["a", "b", "c", "d"])
+    assert missing == [1]
+
+def test_batch_larger_than_sql_limit(tmp_path):
+    texts = ["sentence {}".format(i) for i in range(SQL_BATCH * 2 + 10)]
+    store = EmbeddingStore(tmp_path, "fake/model")
+    store.add(texts[::2], vecs_of(texts[::2]))
+    vecs, missing = store.lookup(texts)
+    assert missing == list(range(1, len(texts), 2))
+    np.testing.assert_array_equal(vecs[::2], vecs_of(texts[::2]))
+    assert store.stats()["hits"] == len(texts[::2])
+
+def test_handles_share_a_store(tmp_path):
+    first = EmbeddingStore(tmp_path, "fake/model")
+    second = EmbeddingStore(tmp_path, "fake/model")
+    first.add(["from a"], vecs_of(["from a"]))
+    second.add(["from b"], vecs_of(["from b"]))
+    vecs, missing = first.lookup(["from b"])
+    assert missing == []
+    np.testing.assert_array_equal(vecs, vecs_of(["from b"]))
+
+    reader = EmbeddingStore(tmp_path, "fake/model", lru_size=0)
+    vecs, missing = reader.lookup(["from a", "from b"])
+    assert missing == []
+    np.testing.assert_array_equal(vecs, vecs_of(["from a", "from b"]))
+
+def test_max_entries_cannot_shrink(tmp_path):
+    texts = ["sentence {}".format(i) for i in range(10)]
+    store = EmbeddingStore(tmp_path, "fake/model", max_entries=10)
+    store.add(texts, vecs_of(texts))
+    store.close()
+    with pytest.raises(ValueError):
+        EmbeddingStore(tmp_path, "fake/model", max_entries=5)
+
+    # growing keeps the old entries and uses the new room before evicting
+    store = EmbeddingStore(tmp_path, "fake/model", max_entries=20, lru_size=0)
+    store.add(["new"], vecs_of(["new"]))
+    vecs, missing = store.lookup(texts + ["new"])
+    assert missing == []
+    np.testing.assert_array_equal(vecs, vecs_of(texts + ["new"]))
+    with pytest.raises(ValueError):
+        EmbeddingStore(tmp_path, "fake/model", max_entries=10)
@@ -0,0 +1,204 @@
+import itertools
+import numba as nb
+import numpy as np
+import pytest
+
+from bertalign.corelib import (chain_anchors, find_first_search_path, first_pass_align, first_pass_align_parallel,
+                               find_second_search_path, get_alignment_types, second_pass_align,
+                               second_pass_align_parallel, second_back_track, compute_band_similarity,
+                               calculate_similarity_score, calculate_length_penalty, compress_vecs,
+                               decompress_vecs, vec_dot, score_beads, calculate_margin)
+
+def random_layers(num_sents, num_layers=4, dim=16, seed=0):
+    rng = np.random.default_rng(seed)
+    vecs = rng.normal(size=(num_layers, num_sents, dim)).astype(np.float32)
+    vecs /= np.linalg.norm(vecs, axis=-1, keepdims=True)
+    lens = rng.integers(10, 200, size=(num_layers, num_sents))
+    return vecs, lens
+
+def random_top_k(src_len, tgt_len, top_k=3, seed=0):
+    rng = np.random.default_rng(seed)
+    index = np.array([rng.choice(tgt_len, top_k, replace=False) for _ in range(src_len)])
+    index[rng.random(index.shape) < 0.1] = -1 # faiss pads with -1
+    dist = rng.uniform(-0.2, 1.0, size=index.shape).astype(np.float32)
+    return dist, index
+
+def diagonal_anchors(src_len, tgt_len):
+    return [(i, max(1, i * tgt_len // src_len)) for i in range(1, src_len + 1, 3)]
+
+@pytest.mark.parametrize("tile_size", [1, 3, 32])
+def test_first_pass_parallel_matches_serial(tile_size):
+    src_len, tgt_len = 70, 64
+    dist, index = random_top_k(src_len, tgt_len)
+    align_types = get_alignment_types(2)
+    w, path = find_first_search_path(src_len, tgt_len, min_win_size=10)
+    serial = first_pass_align(src_len, tgt_len, w, path, align_types, dist, index)
+    parallel = first_pass_align_parallel(src_len, tgt_len, w, path, align_types, dist, index, tile_size)
+    np.testing.assert_array_equal(serial, parallel)
+
+@pytest.mark.parametrize("tile_size", [1, 3, 32])
+@pytest.mark.parametrize("margin", [False, True])
+def test_second_pass_parallel_matches_serial(tile_size, margin):
+    src_vecs, src_lens = random_layers(50, seed=1)
+    tgt_vecs, tgt_lens = random_layers(44, seed=2)
+    align_types = get_alignment_types(5)
+    offsets, path = find_second_search_path(diagonal_anchors(50, 44), 4, 50, 44)
+    args = (src_vecs, tgt_vecs, src_lens, tgt_lens, offsets, path, align_types, 1.0, -0.1, margin, True)
+    serial = second_pass_align(*args)
+    parallel = second_pass_align_parallel(*args, tile_size=tile_size)
+    np.testing.assert_array_equal(serial, parallel)
+
+def dense_second_pass(src_vecs, tgt_vecs, src_lens, tgt_lens, search_path, align_types, char_ratio, skip, margin):
+    """第二步DP原来的写法：(src_len + 1) x (tgt_len + 1)的稠密矩阵"""
+    src_len = src_vecs.shape[1]
+    tgt_len = tgt_vecs.shape[1]
+    cost = np.zeros((src_len + 1, tgt_len + 1), dtype=np.float32)
+    pointers = np.zeros((src_len + 1, tgt_len + 1), dtype=np.uint8)
+    for i in range(src_len + 1):
+        for j in range(search_path[i][0], search_path[i][1] + 1):
+            if i + j == 0:
+                continue
+            best_score = -np.inf
+            best_a = -1
+            for a, (a_1, a_2) in enumerate(align_types):
+                prev_i = i - a_1
+                prev_j = j - a_2
+                if prev_i < 0 or prev_j < 0 or not search_path[prev_i][0] <= prev_j <= search_path[prev_i][1]:
+                    continue
+                if a_1 == 0 or a_2 == 0:
+                    cur_score = skip
+                else:
+                    cur_score = calculate_similarity_score(src_vecs, tgt_vecs, i, j, a_1, a_2, src_len, tgt_len, margin=margin)
+                    cur_score *= calculate_length_penalty(src_lens, tgt_lens, i, j, a_1, a_2, char_ratio)
+                score = cost[prev_i][prev_j] + cur_score
+                if score > best_score:
+                    best_score = score
+                    best_a = a
+            cost[i][j] = best_score
+            pointers[i][j] = best_a
+
+    alignment = []
+    i, j = src_len, tgt_len
+    while i > 0 or j > 0:
+        s, t = align_types[pointers[i][j]]
+        alignment.append((list(range(i - s, i)), list(range(j - t, j))))
+        i -= s
+        j -= t
+    return alignment[::-1]
+
+@pytest.mark.parametrize("margin", [False, True])
+@pytest.mark.parametrize("use_band", [False, True])
+def test_csr_second_pass_matches_dense(margin, use_band):
+    src_len, tgt_len = 40, 36
+    src_vecs, src_lens = random_layers(src_len, seed=3)
+    tgt_vecs, tgt_lens = random_layers(tgt_len, seed=4)
+    align_types = get_alignment_types(5)
+    offsets, path = find_second_search_path(diagonal_anchors(src_len, tgt_len), 3, src_len, tgt_len)
+    band = None
+    if use_band:
+        band = compute_band_similarity(src_vecs, tgt_vecs, offsets, path, align_types, margin=margin)
+    pointers = second_pass_align(src_vecs, tgt_vecs, src_lens, tgt_lens, offsets, path, align_types,
+                                 1.0, -0.1, margin, True, band=band)
+    assert pointers.shape == (offsets[-1],)
+    alignment = second_back_track(src_len, tgt_len, pointers, offsets, path, align_types)
+    expected = dense_second_pass(src_vecs, tgt_vecs, src_lens, tgt_lens, path, align_types, 1.0, -0.1, margin)
+    assert alignment == expected
+
+@pytest.mark.parametrize("seed", range(5))
+def test_chain_anchors_is_best_chain(seed):
+    src_len, tgt_len, top_k = 8, 10, 2
+    dist, index = random_top_k(src_len, tgt_len, top_k, seed)
+    anchors = chain_anchors(tgt_len, dist, index)
+    assert np.all(np.diff(anchors, axis=0) > 0)
+    weight = {(i + 1, index[i][k] + 1): dist[i][k] for i in range(src_len) for k in range(top_k)}
+    score = sum(weight[tuple(anchor)] for anchor in anchors.tolist())
+
+    # 每个源句子不选或选一个候选，穷举所有组合里严格递增的链
+    best = 0.0
+    for picks in itertools.product(range(-1, top_k), repeat=src_len):
+        chain = [(i, index[i][k], dist[i][k]) for i, k in enumerate(picks) if k >= 0]
+        if any(j < 0 or w <= 0 for _, j, w in chain):
+            continue
+        if all(a[1] < b[1] for a, b in zip(chain, chain[1:])):
+            best = max(best, sum(w for _, _, w in chain))
+    assert score == pytest.approx(best, rel=1e-5)
+
+def test_compress_round_trip():
+    vecs, _ = random_layers(20, seed=5)
+    fp16, scales = compress_vecs(vecs, "float16")
+    assert fp16.dtype == np.uint16 and scales is None
+    np.testing.assert_array_equal(decompress_vecs(fp16), vecs.astype(np.float16).astype(np.float32))
+    int8, scales = compress_vecs(vecs, "int8")
+    assert int8.dtype == np.int8 and scales.shape == vecs.shape[:-1]
+    assert np.all(np.abs(decompress_vecs(int8, scales) - vecs) <= scales[..., None] / 2 + 1e-7)
+    with pytest.raises(Exception, match="Unknown vector dtype"):
+        compress_vecs(vecs, "bfloat16")
+
+@nb.njit
+def jit_vec_dot(x, y):
+    return vec_dot(x, y)
+
+def test_vec_dot_kernels():
+    vecs, _ = random_layers(2, num_layers=1, dim=64, seed=6)
+    x, y = vecs[0]
+    fp16, _ = compress_vecs(vecs[0], "float16")
+    assert jit_vec_dot(fp16[0], fp16[1]) == pytest.approx(vec_dot(fp16[0], fp16[1]), rel=1e-5)
+    int8, _ = compress_vecs(vecs[0], "int8")
+    assert jit_vec_dot(int8[0], int8[1]) == np.dot(int8[0].astype(np.int32), int8[1].astype(np.int32))
+    assert jit_vec_dot(x, y) == pytest.approx(np.dot(x, y), rel=1e-5)
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+@pytest.mark.parametrize("use_band", [False, True])
+def test_second_pass_compressed_matches_float32(dtype, use_band):
+    src_len, tgt_len = 40, 40
+    src_vecs, src_lens = random_layers(src_len, seed=7)
+    tgt_vecs = src_vecs + np.random.default_rng(8).normal(scale=0.05, size=src_vecs.shape).astype(np.float32)
+    tgt_vecs /= np.linalg.norm(tgt_vecs, axis=-1, keepdims=True)
+    align_types = get_alignment_types(5)
+    offsets, path = find_second_search_path(diagonal_anchors(src_len, tgt_len), 3, src_len, tgt_len)
+
+    def align(src_vecs, tgt_vecs, src_scales=None, tgt_scales=None):
+        band = None
+        if use_band:
+            band = compute_band_similarity(src_vecs, tgt_vecs, offsets, path, align_types, True, src_scales, tgt_scales)
+        pointers = second_pass_align(src_vecs, tgt_vecs, src_lens, src_lens, offsets, path, align_types, 1.0, -0.1,
+                                     True, True, src_scales, tgt_scales, band=band)
+        return second_back_track(src_len, tgt_len, pointers, offsets, path, align_types)
+
+    src_small, src_scales = compress_vecs(src_vecs, dtype)
+    tgt_small, tgt_scales = compress_vecs(tgt_vecs, dtype)
+    expected = align(src_vecs, tgt_vecs)
+    assert expected == [([i], [i]) for i in range(src_len)]
+    assert align(src_small, tgt_small, src_scales, tgt_scales) == expected
+
+@pytest.mark.parametrize("margin", [False, True])
+def test_score_beads_matches_dp_scores(margin):
+    src_len, tgt_len = 40, 36
+    src_vecs, src_lens = random_layers(src_len, seed=3)
+    tgt_vecs, tgt_lens = random_layers(tgt_len, seed=4)
+    align_types = get_alignment_types(5)
+    offsets, path = find_second_search_path(diagonal_anchors(src_len, tgt_len), 3, src_len, tgt_len)
+    pointers = second_pass_align(src_vecs, tgt_vecs, src_lens, tgt_lens, offsets, path, align_types,
+                                 1.2, -0.1, margin, True)
+    alignment = second_back_track(src_len, tgt_len, pointers, offsets, path, align_types)
+    assert any(not src or not tgt for src, tgt in alignment)
+
+    src_end = np.array([src[-1] + 1 if src else 0 for src, _ in alignment])
+    tgt_end = np.array([tgt[-1] + 1 if tgt else 0 for _, tgt in alignment])
+    src_overlap = np.array([len(src) for src, _ in alignment])
+    tgt_overlap = np.array([len(tgt) for _, tgt in alignment])
+    scores, similarity, margins = score_beads(src_vecs, tgt_vecs, src_lens, tgt_lens, src_end, tgt_end,
+                                              src_overlap, tgt_overlap, 1.2, -0.1, margin, True)
+    for k, (i, j, a_1, a_2) in enumerate(zip(src_end, tgt_end, src_overlap, tgt_overlap)):
+        if a_1 == 0 or a_2 == 0:
+            assert scores[k] == np.float32(-0.1)
+            assert np.isnan(similarity[k]) and np.isnan(margins[k])
+            continue
+        sim = calculate_similarity_score(src_vecs, tgt_vecs, i, j, a_1, a_2, src_len, tgt_len)
+        assert similarity[k] == pytest.approx(sim, abs=1e-6)
+        expected = sim
+        if margin:
+            expected -= calculate_margin(src_vecs, tgt_vecs, i, j, a_1, a_2, src_len, tgt_len)
+        assert margins[k] == pytest.approx(expected, abs=1e-6)
+        expected *= calculate_length_penalty(src_lens, tgt_lens, i, j, a_1, a_2, 1.2)
+        assert scores[k] == pytest.approx(expected, abs=1e-6)
@@ -0,0 +1,75 @@
+import re
+import numpy as np
+
+from bertalign.encoder import Encoder
+from bertalign.utils import yield_overlaps
+
+from conftest import FakeModel
+
+DOCS = [
+    ["Der Hund schläft.", "Die Katze auch.", "Der Hund schläft.", "Es regnet."],
+    ["Es regnet.", "Der Hund schläft."],
+]
+
+def test_transform_many_encodes_distinct_strings_once():
+    model = FakeModel()
+    results = Encoder("fake", backend=model).transform_many(DOCS, 2)
+    encoded = [line for call in model.calls for line in call]
+    assert len(encoded) == len(set(encoded))
+
+    for sents, (sent_vecs, len_vecs) in zip(DOCS, results):
+        assert sent_vecs.shape == (2, len(sents), model.dim)
+        lines = list(yield_overlaps(sents, 2))
+        for layer in range(2):
+            for pos in range(layer, len(sents)):
+                np.testing.assert_allclose(sent_vecs[layer, pos], model.encode([lines[layer * len(sents) + pos]])[0], rtol=1e-6)
+
+def test_encode_batched_buckets_by_length():
+    model = FakeModel()
+    lines = ["s{} ".format(i) * count for i, count in enumerate([12, 2, 9, 1, 3, 11, 6, 2])]
+    encoder = Encoder("fake", backend=model, max_tokens=60, max_batch_size=3)
+    vecs = encoder.encode_batched(lines)
+    np.testing.assert_allclose(vecs, model.encode(lines), rtol=1e-6)
+
+    batches = model.calls[:-1]
+    assert [len(line) for batch in batches for line in batch] == sorted(len(line) for line in lines)
+    for batch in batches:
+        assert len(batch) <= 3
+        assert len(batch) == 1 or len(batch) * max(map(len, batch)) <= 60
+
+def test_encode_batched_empty():
+    encoder = Encoder("fake", backend=FakeModel(dim=16))
+    assert encoder.encode_batched([]).shape == (0, 16)
+
+class WordTokenizer:
+    """按空格切词的fast tokenizer，只给出offset mapping"""
+    is_fast = True
+
+    def __call__(self, lines, add_special_tokens, truncation, max_length, return_offsets_mapping):
+        offsets = [[word.span() for word in re.finditer(r"\S+", line)][:max_length] for line in lines]
+        return {"offset_mapping": offsets}
+
+def test_truncate_at_max_seq_length():
+    model = FakeModel()
+    model.tokenizer = WordTokenizer()
+    model.get_max_seq_length = lambda: 6
+    lines, lengths = Encoder("fake", backend=model).truncate(["a b c d e f g", "a b"])
+    assert lines == ["a b c d", "a b"]
+    assert list(lengths) == [6, 4]
+
+def test_transform_zeroes_pad_rows():
+    sent_vecs, len_vecs = Encoder("fake", backend=FakeModel()).transform(DOCS[0], 3)
+    for layer in range(3):
+        assert not sent_vecs[layer, :layer].any()
+        assert sent_vecs[layer, layer:].any(axis=1).all()
+
+def test_transform_many_in_small_chunks():
+    model = FakeModel()
+    encoder = Encoder("fake", backend=model)
+    whole = encoder.transform_many(DOCS, 3)
+    num_calls = len(model.calls)
+    chunked = encoder.transform_many(DOCS, 3, chunk_size=2)
+    assert all(len(call) <= 2 for call in model.calls[num_calls:])
+    for (sent_vecs, len_vecs), (chunk_vecs, chunk_lens) in zip(whole, chunked):
+        np.testing.assert_array_equal(chunk_vecs, sent_vecs)
+        np.testing.assert_array_equal(chunk_lens, len_vecs)
@@ -0,0 +1,49 @@
+import os
+import numpy as np
+import pytest
+
+from bertalign.pool import EncoderPool
+
+class LengthModel:
+    """不依赖torch的后端，句向量是(字符数, 1)"""
+    def encode(self, lines, batch_size=32):
+        if "die" in lines:
+            os._exit(3)
+        if "fail" in lines:
+            raise ValueError("cannot encode")
+        return np.array([[len(line), 1.0] for line in lines], dtype=np.float32)
+
+class ThreadedModel(LengthModel):
+    def set_num_threads(self, num_threads):
+        self.num_threads = num_threads
+
+    def encode(self, lines, batch_size=32):
+        return np.array([[len(line), self.num_threads] for line in lines], dtype=np.float32)
+
+@pytest.fixture
+def pool():
+    pool = EncoderPool(LengthModel(), num_workers=2, chunk_size=2)
+    yield pool
+    pool.close()
+
+def test_encode_keeps_order(pool):
+    lines = ["ccc", "a", "bbbbb", "dd", ""]
+    np.testing.assert_array_equal(pool.encode(lines)[:, 0], [len(line) for line in lines])
+
+def test_backend_error_fails_request(pool):
+    with pytest.raises(ValueError):
+        pool.encode(["fail", "x"])
+    assert pool.encode(["ok"]).shape == (1, 2)
+
+def test_dead_worker_fails_its_requests(pool):
+    with pytest.raises(RuntimeError, match="exited"):
+        pool.submit(["die"]).result(timeout=30)
+    # the other worker keeps serving
+    assert pool.encode(["abc", "de", "f"])[:, 0].tolist() == [3, 2, 1]
+
+def test_backend_sets_its_own_threads():
+    pool = EncoderPool(ThreadedModel(), num_workers=1, threads_per_worker=3)
+    try:
+        assert pool.encode(["a"]).tolist() == [[1, 3]]
+    finally:
+        pool.close()
@@ -0,0 +1,59 @@
+import json
+import xml.etree.ElementTree as ET
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from bertalign.result import BeadArray, ResultWriter, JsonlWriter, ParquetWriter, TmxWriter
+
+BEADS = [([0], [0]), ([1, 2], [1]), ([3], []), ([], [2]), ([4], [3, 4])]
+SRC = ["Eins.", "Zwei", "und drei.", "Vier.", "<Fünf> & \x01sechs."]
+TGT = ["Un.", "Deux et trois.", "Quatre.", "Cinq", "et six."]
+
+def fake_aligner(score=None):
+    beads = BeadArray.from_beads(BEADS)
+    beads.score = score
+    return SimpleNamespace(record="r1", pivot="fr", result={"de": beads},
+                           sents={"de": {"text_lines": SRC}, "fr": {"text_lines": TGT}})
+
+def test_bead_array_round_trip():
+    beads = BeadArray.from_beads(BEADS)
+    assert list(beads) == BEADS
+    assert beads == BeadArray.from_beads(list(beads))
+    assert beads.types.tolist() == [[1, 1], [2, 1], [1, 0], [0, 1], [1, 2]]
+    assert list(beads.texts(SRC, TGT))[1] == ("Zwei und drei.", "Deux et trois.")
+
+def test_result_writer_is_abstract():
+    with pytest.raises(TypeError):
+        ResultWriter("out")
+
+def test_jsonl_writer(tmp_path):
+    path = tmp_path / "out.jsonl"
+    with JsonlWriter(path) as writer:
+        writer.write(fake_aligner(np.arange(5, dtype=np.float32) / 4))
+        writer.write(fake_aligner())
+    items = [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+    assert len(items) == 2 * len(BEADS)
+    assert items[1] == {"record": "r1", "src_lang": "de", "tgt_lang": "fr",
+                        "src": "Zwei und drei.", "tgt": "Deux et trois.", "score": 0.25}
+    assert items[2]["tgt"] == "" and items[3]["src"] == ""
+    assert "score" not in items[5]
+
+def test_tmx_writer_skips_indels(tmp_path):
+    path = tmp_path / "out.tmx"
+    with TmxWriter(path, srclang="fr") as writer:
+        writer.write(fake_aligner())
+    units = ET.parse(path).getroot().find("body").findall("tu")
+    assert [[seg.text for seg in unit.iter("seg")] for unit in units] == [
+        ["Un.", "Eins."], ["Deux et trois.", "Zwei und drei."], ["Cinq et six.", "<Fünf> & sechs."]]
+
+def test_parquet_writer(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    path = tmp_path / "out.parquet"
+    with ParquetWriter(path) as writer:
+        writer.write(fake_aligner(np.ones(5, dtype=np.float32)))
+    table = pq.read_table(path)
+    assert table.column("src_end").to_pylist() == [1, 3, 4, 4, 5]
+    assert table.column("tgt").to_pylist()[4] == "Cinq et six."
+    assert table.column("score").to_pylist() == [1.0] * 5
@@ -0,0 +1,30 @@
+import asyncio
+
+from bertalign.server import AlignServer, BadRequest
+
+GOOD = {"record": "1", "de": "a b c.\nd e f.\ng h i.", "fr": "a b c.\nd e f.\ng h i."}
+
+def test_bad_rows_fail_alone(fake_model):
+    async def run():
+        server = AlignServer(langs=["de", "fr"], pivot="fr", is_splited=True, log_func=lambda s: None, max_wait=0.05)
+        await server.start(port=0)
+        rows = [GOOD, [1, 2], {"de": "x", "fr": "y"}, {"record": "2", "de": "x"}, dict(GOOD, record="3")]
+        results = await asyncio.gather(*[server.align(row) for row in rows])
+        server.close()
+        return server, results
+
+    server, results = asyncio.run(run())
+    assert [status for status, _ in results] == [200, 400, 400, 400, 200]
+    assert results[0][1]["result"]["de"]["beads"] == results[4][1]["result"]["de"]["beads"]
+    assert server.stats["bad_request"] == 3
+    assert server.stats["aligned"] == 2
+    assert server._pending == 0
+    assert not server._tasks
+
+def test_encode_batch_isolates_failing_rows(fake_model):
+    server = AlignServer(langs=["de", "fr"], pivot="fr", is_splited=True, log_func=lambda s: None)
+    aligners = server._encode_batch([GOOD, {"record": "2", "de": "x"}, GOOD])
+    assert isinstance(aligners[1], BadRequest)
+    for aligner in aligners[0], aligners[2]:
+        aligner.align_sents()
+        assert aligner.result["de"].types.tolist() == [[1, 1]] * 3
@@ -0,0 +1,11 @@
+import numpy as np
+import pytest
+
+from bertalign.utils import yield_overlaps, overlap_lengths
+
+@pytest.mark.parametrize("num_overlaps, first_overlap", [(4, 1), (4, 2), (1, 1), (6, 1)])
+def test_overlap_lengths_match_strings(num_overlaps, first_overlap):
+    lines = ["Ein Satz.", "  Zwei  Sätze. ", "三个句子。", "x", "Fünf."]
+    lines_out = list(yield_overlaps(lines, num_overlaps, first_overlap))
+    expected = np.array([len(line.encode("utf-8")) for line in lines_out]).reshape(-1, len(lines))
+    np.testing.assert_array_equal(overlap_lengths(lines, num_overlaps, first_overlap), expected)